@@ -0,0 +1,286 @@
+"""Throughput and latency percentiles of every endpoint at growing scale.
+
+Seeds a scratch database with synthetic questions at each size, then drives
+the listing, deep pages, category listing, search, quiz rounds with a
+growing `previous_questions`, create and delete through the Flask test
+client. Prints one JSON document with requests per second and p50, p95 and
+p99 latency per size and scenario, suitable as a baseline for later runs.
+
+Runs against a temporary SQLite database by default, any scratch database
+given with --database-url, or a throwaway Postgres cluster with
+--embedded-postgres (requires `testing.postgresql` and the Postgres server
+binaries). All trivia tables of the database are dropped and recreated.
+
+Usage (from the backend folder):
+
+    python benchmarks/bench_api.py --sizes 10000 100000 1000000 \\
+        --output results.json
+    python benchmarks/bench_api.py --baseline results.json --tolerance 0.2
+
+With --baseline the run exits with status 1 if the p95 latency of any
+scenario grew, or its throughput dropped, by more than the tolerance, or if
+its error count or error rate grew at all.
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from bench_pagination import CATEGORIES, WORDS, seed  # noqa: E402
+from flaskr import QUESTIONS_PER_PAGE, create_app  # noqa: E402
+
+# questions played per quiz round, previous_questions grows up to it
+QUIZ_ROUND_LENGTH = 50
+
+
+def list_questions(client, state):
+    return client.get("/questions?page={}".format(random.randint(1, 10)))
+
+
+def deep_page(client, state):
+    last_page = max(1, state["size"] // QUESTIONS_PER_PAGE)
+    return client.get(
+        "/questions?page={}".format(
+            random.randint(max(1, last_page // 2), last_page)
+        )
+    )
+
+
+def category_listing(client, state):
+    return client.get(
+        "/categories/{}/questions?page={}".format(
+            random.randint(1, len(CATEGORIES)), random.randint(1, 10)
+        )
+    )
+
+
+def search(client, state):
+    return client.post(
+        "/questions", json={"searchTerm": "the " + random.choice(WORDS)}
+    )
+
+
+def quiz_round(client, state):
+    previous_questions = state.setdefault("previous_questions", [])
+    if len(previous_questions) >= QUIZ_ROUND_LENGTH:
+        previous_questions.clear()
+    res = client.post(
+        "/quizzes",
+        json={
+            "previous_questions": previous_questions,
+            "quiz_category": {"id": 1},
+        },
+    )
+    if res.status_code == 200 and "question" in res.json:
+        previous_questions.append(res.json["question"]["id"])
+    return res
+
+
+def create(client, state):
+    res = client.post(
+        "/questions",
+        json={
+            "question": "Benchmark question {}?".format(random.random()),
+            "answer": "Benchmark answer",
+            "category": random.randint(1, len(CATEGORIES)),
+            "difficulty": random.randint(1, 5),
+        },
+    )
+    if res.status_code == 200:
+        state.setdefault("created", []).append(res.json["created"])
+    return res
+
+
+def delete(client, state):
+    # deletes the questions added by the create scenario
+    return client.delete("/questions/{}".format(state["created"].pop()))
+
+
+SCENARIOS = {
+    "list": list_questions,
+    "deep_page": deep_page,
+    "category": category_listing,
+    "search": search,
+    "quiz_round": quiz_round,
+    "create": create,
+    "delete": delete,
+}
+
+
+def run_scenario(client, scenario, state, requests):
+    """Send `requests` requests of `scenario`, return their statistics."""
+    timings = []
+    errors = 0
+    started_at = time.perf_counter()
+    for _ in range(requests):
+        start = time.perf_counter()
+        res = scenario(client, state)
+        timings.append((time.perf_counter() - start) * 1000)
+        if res.status_code >= 400:
+            errors += 1
+    elapsed = time.perf_counter() - started_at
+    percentiles = statistics.quantiles(timings, n=100)
+    return {
+        "requests": requests,
+        "errors": errors,
+        "throughput_rps": round(requests / elapsed, 1),
+        "p50_ms": round(percentiles[49], 3),
+        "p95_ms": round(percentiles[94], 3),
+        "p99_ms": round(percentiles[98], 3),
+    }
+
+
+def error_rate(result):
+    return result["errors"] / result["requests"]
+
+
+def compare(results, baseline, tolerance):
+    """Return the regressions of `results` against `baseline`."""
+    previous = {
+        (result["size"], result["scenario"]): result
+        for result in baseline["results"]
+    }
+    regressions = []
+    for result in results:
+        before = previous.get((result["size"], result["scenario"]))
+        if before is None:
+            continue
+        if result["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            regressions.append(
+                "{scenario} at {size} rows: p95 {p95_ms}ms".format(**result)
+                + " (baseline {}ms)".format(before["p95_ms"])
+            )
+        if result["throughput_rps"] < before["throughput_rps"] * (
+            1 - tolerance
+        ):
+            regressions.append(
+                "{scenario} at {size} rows: {throughput_rps} req/s".format(
+                    **result
+                )
+                + " (baseline {} req/s)".format(before["throughput_rps"])
+            )
+        # any rise fails, errors are not subject to the tolerance
+        errors_grew = result["errors"] > before["errors"]
+        if errors_grew or error_rate(result) > error_rate(before):
+            regressions.append(
+                "{scenario} at {size} rows: {errors} errors".format(**result)
+                + " in {} requests".format(result["requests"])
+                + " (baseline {} in {})".format(
+                    before["errors"], before["requests"]
+                )
+            )
+    return regressions
+
+
+def embedded_postgres():
+    """Start a throwaway Postgres cluster, return it and its URL."""
+    import testing.postgresql
+
+    postgresql = testing.postgresql.Postgresql()
+    return postgresql, postgresql.url()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10000, 100000, 1000000]
+    )
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS)
+    )
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--database-url", default=None)
+    parser.add_argument("--embedded-postgres", action="store_true")
+    parser.add_argument(
+        "--with-cache",
+        action="store_true",
+        help="keep the response cache on, by default every request does "
+        "the full work of its endpoint",
+    )
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--baseline", default=None)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    postgresql = None
+    if args.embedded_postgres:
+        postgresql, database_url = embedded_postgres()
+    else:
+        database_url = args.database_url or "sqlite:///{}".format(
+            os.path.join(tempfile.mkdtemp(), "bench.db")
+        )
+    config = {
+        "SQLALCHEMY_DATABASE_URI": database_url,
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+    }
+    if not args.with_cache:
+        config["RESPONSE_CACHE_MAX_BYTES"] = 0
+
+    results = []
+    try:
+        for size in args.sizes:
+            seed(create_app(config), size)
+            # a fresh app starts with empty caches and loads the new rows
+            client = create_app(config).test_client()
+            state = {"size": size}
+            for name in args.scenarios:
+                requests = args.requests
+                if name == "delete":
+                    requests = min(requests, len(state.get("created", [])))
+                if not requests:
+                    continue
+                result = run_scenario(client, SCENARIOS[name], state, requests)
+                results.append({"size": size, "scenario": name, **result})
+                print(
+                    "{:>8} {:<11} {:>8.1f} req/s  p50 {:>8.2f}ms  "
+                    "p95 {:>8.2f}ms  p99 {:>8.2f}ms".format(
+                        size,
+                        name,
+                        result["throughput_rps"],
+                        result["p50_ms"],
+                        result["p95_ms"],
+                        result["p99_ms"],
+                    ),
+                    file=sys.stderr,
+                )
+    finally:
+        if postgresql is not None:
+            postgresql.stop()
+
+    report = {
+        "database": database_url.split(":", 1)[0],
+        "requests": args.requests,
+        "response_cache": args.with_cache,
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("regression: " + regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
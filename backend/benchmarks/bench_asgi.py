@@ -0,0 +1,134 @@
+"""Throughput and tail latency of the WSGI and the ASGI app under load.
+
+Drives already running servers with a quiz-heavy mix of requests from
+concurrent keep-alive connections and reports requests per second and the
+p50 and p99 latency of each. Start both apps against the same Postgres
+database with the same number of workers, pinned to the same cores, with
+the rate limits of the Flask app turned off:
+
+    LIMITS_ENABLED=false taskset -c 0-3 gunicorn -w 4 -b :5000 \\
+        "flaskr:create_app()"
+    taskset -c 0-3 uvicorn --factory flaskr.asgi:create_asgi_app \\
+        --workers 4 --port 8000
+
+then, from another set of cores:
+
+    python benchmarks/bench_asgi.py \\
+        http://localhost:5000 http://localhost:8000 --connections 64
+
+Every response other than 2xx, e.g. a 429 of a rate limit, counts as an
+error.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+from urllib.parse import urlsplit
+
+# (share of requests, method, path, body)
+REQUEST_MIX = [
+    (0.6, "POST", "/quizzes", {"previous_questions": [], "quiz_category": {}}),
+    (0.2, "GET", "/questions?page=2", None),
+    (0.1, "GET", "/categories/1/questions", None),
+    (0.1, "GET", "/categories", None),
+]
+
+
+def build_requests(host):
+    requests = []
+    for _, method, path, body in REQUEST_MIX:
+        payload = b"" if body is None else json.dumps(body).encode()
+        head = "{} {} HTTP/1.1\r\nHost: {}\r\n".format(method, path, host)
+        if body is not None:
+            head += "Content-Type: application/json\r\n"
+        head += "Content-Length: {}\r\n\r\n".format(len(payload))
+        requests.append(head.encode() + payload)
+    return requests
+
+
+async def read_response(reader):
+    """Read one HTTP/1.1 response, return its status code."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed by the server")
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    await reader.readexactly(length)
+    return int(status_line.split()[1])
+
+
+async def worker(url, requests, weights, deadline, timings, errors):
+    parts = urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port)
+    try:
+        while time.perf_counter() < deadline:
+            request = random.choices(requests, weights)[0]
+            start = time.perf_counter()
+            writer.write(request)
+            status = await read_response(reader)
+            timings.append(time.perf_counter() - start)
+            if not 200 <= status < 300:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def load(url, connections, duration):
+    """Keep `connections` requests in flight for `duration` seconds."""
+    requests = build_requests(urlsplit(url).netloc)
+    weights = [share for share, *_ in REQUEST_MIX]
+    timings, errors = [], []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(
+        *[
+            worker(url, requests, weights, deadline, timings, errors)
+            for _ in range(connections)
+        ]
+    )
+    percentiles = statistics.quantiles(timings, n=100)
+    return {
+        "requests_per_second": len(timings) / duration,
+        "p50_ms": percentiles[49] * 1000,
+        "p99_ms": percentiles[98] * 1000,
+        "errors": len(errors),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("urls", nargs="+")
+    parser.add_argument("--connections", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--warmup", type=float, default=5)
+    args = parser.parse_args()
+
+    print(
+        "{:<30} {:>10} {:>10} {:>10} {:>8}".format(
+            "server", "req/s", "p50", "p99", "errors"
+        )
+    )
+    for url in args.urls:
+        asyncio.run(load(url, args.connections, args.warmup))
+        result = asyncio.run(load(url, args.connections, args.duration))
+        print(
+            "{:<30} {:>10.0f} {:>8.2f}ms {:>8.2f}ms {:>8}".format(
+                url,
+                result["requests_per_second"],
+                result["p50_ms"],
+                result["p99_ms"],
+                result["errors"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Rows per second of the ORM and the lean serialization paths.
+
+Compares hydrating `Question` objects and calling `Question.format()` plus
+`jsonify` with selecting column tuples and serializing them with
+`flaskr.serialization.dumps` (orjson if installed). Both paths read the
+same rows from a scratch SQLite database.
+
+Usage (from the backend folder):
+
+    python benchmarks/bench_serialization.py --rows 100000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from flask import jsonify  # noqa: E402
+
+from bench_pagination import seed  # noqa: E402
+from flaskr import create_app  # noqa: E402
+from flaskr.serialization import (  # noqa: E402
+    dumps,
+    format_rows,
+    orjson,
+    question_rows,
+)
+from models import Question  # noqa: E402
+
+
+def orm_path(limit):
+    questions = Question.query.order_by(Question.id).limit(limit).all()
+    return jsonify({"questions": [q.format() for q in questions]}).data
+
+
+def lean_path(limit):
+    rows = question_rows(Question.query).order_by(Question.id).limit(limit)
+    return dumps({"questions": format_rows(rows)})
+
+
+def rows_per_second(path, limit, min_seconds=1.0):
+    runs = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < min_seconds:
+        path(limit)
+        runs += 1
+    return runs * limit / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument(
+        "--limits", type=int, nargs="+", default=[10, 100, 10000]
+    )
+    args = parser.parse_args()
+
+    app = create_app(
+        {
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///{}".format(
+                os.path.join(tempfile.mkdtemp(), "bench.db")
+            ),
+            "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+        }
+    )
+    seed(app, args.rows)
+    print("json encoder: {}".format("orjson" if orjson else "json"))
+    print("{:>8} {:>14} {:>14} {:>8}".format("rows", "orm", "lean", "speedup"))
+    with app.test_request_context():
+        for limit in args.limits:
+            orm = rows_per_second(orm_path, limit)
+            lean = rows_per_second(lean_path, limit)
+            print(
+                "{:>8} {:>10.0f}/s {:>12.0f}/s {:>7.1f}x".format(
+                    limit, orm, lean, lean / orm
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Cold start time of a worker, from process start to the first response.
+
+Starts a fresh Python process per run which imports the app, calls
+`create_app` and serves `GET /categories` through the test client. Reports
+the median time of the imports, of `create_app` and of the first request,
+and the total wall time including the interpreter start, once with the
+default startup and once with DB_CREATE_ALL and PRELOAD_INDEXES off.
+
+Runs against a temporary SQLite database seeded with --size questions by
+default, or any scratch database given with --database-url, whose trivia
+tables are dropped and recreated.
+
+Usage (from the backend folder):
+
+    python benchmarks/bench_startup.py --size 100000 --runs 5
+    python benchmarks/bench_startup.py --max-seconds 1.5
+
+With --max-seconds the run exits with status 1 if the median total of any
+mode exceeds it.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+# run in the child process, prints the timings of its phases as json
+CHILD = """
+import json, os, sys, time
+started_at = time.perf_counter()
+from flaskr import create_app
+imported_at = time.perf_counter()
+app = create_app(json.loads(os.environ["BENCH_STARTUP_CONFIG"]))
+created_at = time.perf_counter()
+status = app.test_client().get("/categories").status_code
+served_at = time.perf_counter()
+json.dump(
+    {
+        "status": status,
+        "import_s": imported_at - started_at,
+        "create_app_s": created_at - imported_at,
+        "first_request_s": served_at - created_at,
+    },
+    sys.stdout,
+)
+"""
+
+MODES = {
+    "default": {},
+    "lazy": {"DB_CREATE_ALL": False, "PRELOAD_INDEXES": False},
+}
+
+
+def start_once(config):
+    """Start a worker process, return the timings of its phases."""
+    env = dict(os.environ, BENCH_STARTUP_CONFIG=json.dumps(config))
+    started_at = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD],
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout
+    timings = json.loads(output)
+    timings["total_s"] = time.perf_counter() - started_at
+    return timings
+
+
+def measure(config, runs):
+    """Median timings of `runs` cold starts."""
+    samples = [start_once(config) for _ in range(runs)]
+    if any(sample["status"] != 200 for sample in samples):
+        raise RuntimeError("the first request failed")
+    return {
+        key: round(statistics.median(s[key] for s in samples), 4)
+        for key in ("import_s", "create_app_s", "first_request_s", "total_s")
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=int, default=10000)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--database-url", default=None)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    parser.add_argument("--max-seconds", type=float, default=None)
+    args = parser.parse_args()
+
+    from bench_pagination import seed
+    from flaskr import create_app
+
+    database_url = args.database_url or "sqlite:///{}".format(
+        os.path.join(tempfile.mkdtemp(), "bench.db")
+    )
+    config = {
+        "SQLALCHEMY_DATABASE_URI": database_url,
+        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+    }
+    seed(create_app(config), args.size)
+
+    results = []
+    for mode in args.modes:
+        result = measure({**config, **MODES[mode]}, args.runs)
+        results.append({"mode": mode, **result})
+        print(
+            "{:<8} import {:>7.3f}s  create_app {:>7.3f}s  "
+            "first request {:>7.3f}s  total {:>7.3f}s".format(
+                mode,
+                result["import_s"],
+                result["create_app_s"],
+                result["first_request_s"],
+                result["total_s"],
+            ),
+            file=sys.stderr,
+        )
+    print(
+        json.dumps(
+            {
+                "database": database_url.split(":", 1)[0],
+                "size": args.size,
+                "runs": args.runs,
+                "results": results,
+            },
+            indent=2,
+        )
+    )
+
+    if args.max_seconds is not None:
+        slow = [r for r in results if r["total_s"] > args.max_seconds]
+        for result in slow:
+            print(
+                "regression: {mode} start took {total_s}s".format(**result)
+                + " (limit {}s)".format(args.max_seconds),
+                file=sys.stderr,
+            )
+        if slow:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,115 @@
-import random
+import io
+import math
 
-from flask import Flask, abort, jsonify, request
+from flask import (
+    Flask,
+    Response,
+    abort,
+    g,
+    jsonify,
+    request,
+    stream_with_context,
+)
 from flask_cors import CORS
-from models import Category, Question, setup_db
+from werkzeug.middleware.proxy_fix import ProxyFix
+from models import (
+    Category,
+    Question,
+    difficulty_counts,
+    listen_for_writes,
+    question_count,
+    setup_db,
+)
+
+from .adaptive import (
+    next_weights,
+    record_answer,
+    session_score,
+    start_adaptive_session,
+)
+from .bulk import (
+    FORMATS,
+    export_questions,
+    import_questions,
+    register_bulk_commands,
+)
+from .category_cache import CategoryCache
+from .http_cache import conditional
+from .instrumentation import (
+    PROMETHEUS_CONTENT_TYPE,
+    configure_instrumentation,
+    render_metrics,
+)
+from .limits import configure_limits
+from .pagination import decode_cursor, paginate, paginate_after
+from .profiling import configure_profiling, register_profiling_commands
+from .quiz import QuestionSampler
+from .quiz_sessions import LRUSessionStore, next_question_id, start_session
+from .pool import configure_pool
+from .replicas import configure_replicas, replica_reads
+from .response_cache import (
+    RedisResponseCache,
+    ResponseCache,
+    cached_response,
+)
+from .schema import register_commands
+from .search import search_questions
+from .serialization import format_rows, format_stats, json_response
+from .streaming import ndjson_response, wants_ndjson
+from .suggest import Suggestions
 
 QUESTIONS_PER_PAGE = 10
+MAX_QUESTIONS_PER_PAGE = 100
+QUESTIONS_PER_QUIZ = 5
+MAX_QUESTIONS_PER_QUIZ = 100
+SUGGESTIONS_PER_TERM = 10
+MAX_SUGGESTIONS_PER_TERM = 50
+
+
+def prefers_minimal_response():
+    """Whether the client sent `Prefer: return=minimal` to skip the listing
+    of questions returned after a write."""
+    preferences = request.headers.get("Prefer", "").replace(" ", "")
+    return "return=minimal" in preferences.split(",")
+
+
+def minimal_response(payload):
+    response = json_response(payload)
+    response.headers["Preference-Applied"] = "return=minimal"
+    return response
 
 
-def paginate(collection_, elements_per_page, page):
-    start_index = elements_per_page * (page - 1)
-    end_index = start_index + elements_per_page
-    return collection_[start_index:end_index]
+def select_page(query, total_questions=None):
+    """Select the requested page of `query` in page or cursor mode.
+
+    Cursor mode is used when the request passes `after` or `limit`.
+    Returns the questions of the page, the total number of matching
+    questions, counted unless passed in, and the response keys specific to
+    the pagination mode.
+    """
+    if "after" not in request.args and "limit" not in request.args:
+        page = request.args.get("page", 1, type=int)
+        questions, total_questions = paginate(
+            query,
+            elements_per_page=QUESTIONS_PER_PAGE,
+            page=page,
+            total=total_questions,
+        )
+        return questions, total_questions, {}
+
+    limit = request.args.get("limit", QUESTIONS_PER_PAGE, type=int)
+    if not 0 < limit <= MAX_QUESTIONS_PER_PAGE:
+        abort(422)
+    after = request.args.get("after")
+    if after is not None:
+        try:
+            after = decode_cursor(after)
+        except ValueError:
+            abort(422)
+    questions, next_cursor = paginate_after(query, after=after, limit=limit)
+    if total_questions is None:
+        total_questions = query.order_by(None).count()
+    return questions, total_questions, {"next_cursor": next_cursor}
 
 
 def create_app(test_config=None):
@@ -23,8 +122,59 @@ def create_app(test_config=None):
         # load the test config if passed in
         app.config.from_mapping(test_config)
 
+    configure_pool(app)
     setup_db(app)
+    configure_replicas(app)
+    # profiles are written while the instrumentation still tracks the SQL
+    configure_profiling(app)
+    configure_instrumentation(app)
+    configure_limits(app)
+    if app.config.get("PROXY_FIX_X_FOR"):
+        # the client address of requests forwarded by reverse proxies, rate
+        # limits would put every client into the proxy's bucket otherwise
+        app.wsgi_app = ProxyFix(
+            app.wsgi_app, x_for=app.config["PROXY_FIX_X_FOR"]
+        )
     CORS(app)
+    register_commands(app)
+    register_bulk_commands(app)
+    register_profiling_commands(app)
+
+    category_cache = CategoryCache(
+        ttl=app.config.get("CATEGORY_CACHE_TTL", 300)
+    )
+    app.extensions["category_cache"] = category_cache
+    listen_for_writes(app, Category, category_cache.invalidate)
+    question_sampler = QuestionSampler(
+        ttl=app.config.get("QUIZ_INDEX_TTL", 300)
+    )
+    app.extensions["question_sampler"] = question_sampler
+    listen_for_writes(app, Question, question_sampler.on_write)
+    suggestions = Suggestions(ttl=app.config.get("SUGGEST_INDEX_TTL", 300))
+    app.extensions["suggestions"] = suggestions
+    listen_for_writes(app, Question, suggestions.on_question_write)
+    listen_for_writes(app, Category, suggestions.on_category_write)
+    quiz_sessions = app.config.get("QUIZ_SESSION_STORE") or LRUSessionStore(
+        max_sessions=app.config.get("QUIZ_SESSION_MAX", 10000),
+        ttl=app.config.get("QUIZ_SESSION_TTL", 3600),
+    )
+    app.extensions["quiz_sessions"] = quiz_sessions
+    if app.config.get("RESPONSE_CACHE_CLIENT") is not None:
+        response_cache = RedisResponseCache(
+            app.config["RESPONSE_CACHE_CLIENT"],
+            ttl=app.config.get("RESPONSE_CACHE_TTL", 3600),
+        )
+    else:
+        response_cache = ResponseCache(
+            max_bytes=app.config.get("RESPONSE_CACHE_MAX_BYTES", 32 * 2**20)
+        )
+    app.extensions["response_cache"] = response_cache
+    if app.config.get("PRELOAD_INDEXES", True):
+        # otherwise loaded by the first request using them
+        with app.app_context():
+            category_cache.refresh()
+            question_sampler.refresh()
+            suggestions.refresh()
 
     # CORS Headers
     @app.after_request
@@ -37,13 +187,18 @@ def create_app(test_config=None):
         )
         return response
 
+    @app.route("/metrics")
+    def get_metrics():
+        """Request, database and cache metrics in the Prometheus format."""
+        return Response(render_metrics(), content_type=PROMETHEUS_CONTENT_TYPE)
+
     @app.route("/categories")
+    @replica_reads
+    @conditional("categories")
+    @cached_response("categories")
     def get_categories():
-        categories = Category.query.all()
-        formatted_categories = {
-            category.id: category.type for category in categories
-        }
-        return jsonify(
+        formatted_categories = category_cache.get()
+        return json_response(
             {
                 "success": True,
                 "categories": formatted_categories,
@@ -52,23 +207,21 @@ def create_app(test_config=None):
         )
 
     @app.route("/questions")
+    @replica_reads
+    @conditional("questions", "categories")
+    @cached_response("questions", "categories")
     def get_questions():
-        page = request.args.get("page", 1, type=int)
+        if wants_ndjson():
+            return ndjson_response(Question.query)
 
-        categories = Category.query.all()
-        formatted_categories = {
-            category.id: category.type for category in categories
-        }
+        formatted_categories = category_cache.get()
 
-        questions = Question.query.all()
-        selected_questions = paginate(
-            questions, elements_per_page=QUESTIONS_PER_PAGE, page=page
+        selected_questions, total_questions, cursor = select_page(
+            Question.query, total_questions=question_count()
         )
         if not selected_questions:
             abort(404)
-        formatted_questions = [
-            question.format() for question in selected_questions
-        ]
+        formatted_questions = format_rows(selected_questions)
 
         # get string rep of first question's category
         try:
@@ -78,13 +231,14 @@ def create_app(test_config=None):
             app.logger.debug(e)
             abort(500)
         else:
-            return jsonify(
+            return json_response(
                 {
                     "success": True,
                     "questions": formatted_questions,
-                    "total_questions": len(questions),
+                    "total_questions": total_questions,
                     "categories": formatted_categories,
                     "current_category": cat_name,
+                    **cursor,
                 }
             )
 
@@ -98,78 +252,81 @@ def create_app(test_config=None):
             else:
                 try:
                     question.delete()
-                    all_questions = question.query.all()
-                    selected_questions = paginate(
-                        all_questions,
+                    if prefers_minimal_response():
+                        return minimal_response(
+                            {"success": True, "deleted": question_id}
+                        )
+                    selected_questions, total_questions = paginate(
+                        Question.query,
                         page=page,
                         elements_per_page=QUESTIONS_PER_PAGE,
+                        total=question_count(),
                     )
-                    formatted_questions = [
-                        question.format() for question in selected_questions
-                    ]
+                    formatted_questions = format_rows(selected_questions)
                 except Exception as e:
                     app.logger.warning(e)
                     abort(500)
                 else:
-                    return jsonify(
+                    return json_response(
                         {
                             "success": True,
                             "deleted": question_id,
-                            "total_questions": len(all_questions),
+                            "total_questions": total_questions,
                             "questions": formatted_questions,
                         }
                     )
 
+    @replica_reads
+    @cached_response("questions", "categories")
+    def search_question():
+        """Search questions by the searchTerm of the request body."""
+        page = request.args.get("page", 1, type=int)
+
+        formatted_categories = category_cache.get()
+
+        search_term = request.json["searchTerm"].lower()
+        matching_questions = search_questions(search_term)
+        if wants_ndjson():
+            return ndjson_response(matching_questions)
+        current_matching_questions, total_questions = paginate(
+            matching_questions,
+            elements_per_page=QUESTIONS_PER_PAGE,
+            page=page,
+        )
+        current_matching_questions = format_rows(current_matching_questions)
+        if not current_matching_questions:
+            return json_response(
+                {
+                    "success": True,
+                    "questions": current_matching_questions,
+                    "total_questions": total_questions,
+                    "current_category": None,
+                }
+            )
+        else:
+            try:
+                cat_id = current_matching_questions[0]["category"]
+                cat_name = formatted_categories[cat_id]
+
+            except KeyError as e:
+                app.logger.debug(e)
+                abort(500)
+            return json_response(
+                {
+                    "success": True,
+                    "questions": current_matching_questions,
+                    "total_questions": total_questions,
+                    "current_category": cat_name,
+                }
+            )
+
     @app.route("/questions", methods=["POST"])
     def post_new_question():
         """Post a new question."""
         page = request.args.get("page", 1, type=int)
 
         if request.json.get("searchTerm"):
-            with app.app_context():
-                categories = Category.query.all()
-                formatted_categories = {
-                    category.id: category.type for category in categories
-                }
-
-                search_term = request.json["searchTerm"].lower()
-                all_matching_questions = Question.query.filter(
-                    Question.question.ilike("%{}%".format(search_term))
-                ).all()
-                current_matching_questions = paginate(
-                    all_matching_questions,
-                    elements_per_page=QUESTIONS_PER_PAGE,
-                    page=page,
-                )
-                current_matching_questions = [
-                    question.format()
-                    for question in current_matching_questions
-                ]
-                if not current_matching_questions:
-                    return jsonify(
-                        {
-                            "success": True,
-                            "questions": current_matching_questions,
-                            "total_questions": len(all_matching_questions),
-                            "current_category": None,
-                        }
-                    )
-                else:
-                    try:
-                        cat_id = current_matching_questions[0]["category"]
-                        cat_name = formatted_categories[cat_id]
-
-                    except KeyError as e:
-                        app.logger.debug(e)
-                        abort(500)
-                    return jsonify(
-                        {
-                            "success": True,
-                            "questions": current_matching_questions,
-                            "total_questions": len(all_matching_questions),
-                            "current_category": cat_name,
-                        }
-                    )
+            return search_question()
 
         else:
             with app.app_context():
@@ -177,68 +334,133 @@ def create_app(test_config=None):
                     question = Question(
                         question=request.json["question"],
                         answer=request.json["answer"],
-                        category=request.json["category"],
-                        difficulty=request.json["difficulty"],
+                        category=int(request.json["category"]),
+                        difficulty=int(request.json["difficulty"]),
                     )
-                except KeyError as e:
+                    if question.category not in category_cache.get():
+                        raise ValueError(
+                            "unknown category {}".format(question.category)
+                        )
+                except (KeyError, TypeError, ValueError) as e:
                     app.logger.warning(e)
                     abort(422)
 
                 else:
                     try:
                         question.insert()
-
-                        all_questions = Question.query.all()
-                        current_questions = paginate(
-                            all_questions,
+                        if prefers_minimal_response():
+                            return minimal_response(
+                                {"success": True, "created": question.id}
+                            )
+                        current_questions, total_questions = paginate(
+                            Question.query,
                             elements_per_page=QUESTIONS_PER_PAGE,
                             page=page,
+                            total=question_count(),
                         )
-                        current_questions = [
-                            question.format() for question in current_questions
-                        ]
+                        current_questions = format_rows(current_questions)
                     except Exception as e:
                         app.logger.debug(e)
                         abort(500)
                     else:
-                        return jsonify(
+                        return json_response(
                             {
                                 "success": True,
                                 "questions": current_questions,
-                                "total_questions": len(all_questions),
+                                "total_questions": total_questions,
                                 "created": question.id,
                             }
                         )
 
+    @app.route("/questions/import", methods=["POST"])
+    def bulk_import_questions():
+        """Import questions streamed as NDJSON or CSV in the request body."""
+        format_ = "csv" if request.mimetype == "text/csv" else "ndjson"
+        lines = io.TextIOWrapper(request.stream, encoding="utf-8", newline="")
+        try:
+            summary = import_questions(lines, format_)
+        except UnicodeDecodeError as e:
+            app.logger.warning(e)
+            abort(422)
+        return jsonify({"success": True, **summary})
+
+    @app.route("/questions/export")
+    def bulk_export_questions():
+        """Stream all questions as NDJSON or CSV."""
+        format_ = request.args.get("format", "ndjson")
+        if format_ not in FORMATS:
+            abort(422)
+        return Response(
+            stream_with_context(export_questions(format_)),
+            mimetype=(
+                "text/csv" if format_ == "csv" else "application/x-ndjson"
+            ),
+        )
+
+    @app.route("/stats")
+    @replica_reads
+    @conditional("questions", "categories")
+    @cached_response("questions", "categories")
+    def get_stats():
+        """Question counts per category and difficulty, read from the
+        maintained summary table instead of counting the questions."""
+        return json_response(
+            format_stats(category_cache.get(), difficulty_counts())
+        )
+
+    @app.route("/suggestions")
+    def get_suggestions():
+        """Questions and categories with a word starting like the last word
+        of the `q` argument, answered from memory as the user types."""
+        limit = request.args.get("limit", SUGGESTIONS_PER_TERM, type=int)
+        if not 0 < limit <= MAX_SUGGESTIONS_PER_TERM:
+            abort(422)
+        return json_response(
+            {
+                "success": True,
+                "suggestions": suggestions.suggest(
+                    request.args.get("q", ""), limit
+                ),
+            }
+        )
+
     @app.route("/categories/<int:category_id>/questions")
+    @replica_reads
+    @conditional("questions", "categories")
+    @cached_response("questions", "categories")
     def get_category(category_id):
-        page = request.args.get("page", 1, type=int)
-
-        category = Category.query.get(category_id)
-        if not category:
+        categories = category_cache.get()
+        if category_id not in categories:
             abort(404)
         else:
             questions_of_category = Question.query.filter(
-                Question.category == category.id
-            ).all()
-            current_questions_of_category = paginate(
+                Question.category == category_id
+            )
+            if wants_ndjson():
+                return ndjson_response(questions_of_category)
+            (
+                current_questions_of_category,
+                total_questions,
+                cursor,
+            ) = select_page(
                 questions_of_category,
-                elements_per_page=QUESTIONS_PER_PAGE,
-                page=page,
+                total_questions=question_count(category_id),
             )
-            current_questions_of_category = [
-                question.format() for question in current_questions_of_category
-            ]
-            return jsonify(
+            current_questions_of_category = format_rows(
+                current_questions_of_category
+            )
+            return json_response(
                 {
                     "success": True,
                     "questions": current_questions_of_category,
-                    "total_questions": len(questions_of_category),
-                    "current_category": category.type,
+                    "total_questions": total_questions,
+                    "current_category": categories[category_id],
+                    **cursor,
                 }
             )
 
     @app.route("/quizzes", methods=["POST"])
+    @replica_reads
     def get_quiz_question():
         try:
             app.logger.debug(request.json)
@@ -247,29 +469,133 @@ def create_app(test_config=None):
         except KeyError as e:
             app.logger.warning(e)
             abort(422)
+
+        try:
+            previous_questions = {int(i) for i in previous_questions}
+            quiz_category_id = int(quiz_category_id or 0) or None
+            count = request.json.get("count")
+            if count is not None:
+                count = int(count)
+                if not 0 < count <= MAX_QUESTIONS_PER_QUIZ:
+                    raise ValueError("count out of range: {}".format(count))
+        except (TypeError, ValueError) as e:
+            app.logger.warning(e)
+            abort(422)
         else:
+            resp_dict = {
+                "success": True,
+            }
             try:
-                if quiz_category_id:
-                    questions = Question.query.filter(
-                        Question.category == quiz_category_id,
-                        ~Question.id.in_(previous_questions),
-                    ).all()
-                else:
-                    questions = Question.query.filter(
-                        ~Question.id.in_(previous_questions),
-                    ).all()
+                if count is not None:
+                    # a whole round of questions in one request
+                    resp_dict["questions"] = format_rows(
+                        question_sampler.sample_many(
+                            quiz_category_id,
+                            excluded=previous_questions,
+                            count=count,
+                        )
+                    )
+                    return jsonify(resp_dict)
+                question = question_sampler.sample(
+                    quiz_category_id, excluded=previous_questions
+                )
             except Exception as e:
                 app.logger.warning(e)
                 abort(500)
             else:
-                resp_dict = {
+                if question:
+                    resp_dict["question"] = question.format()
+                return jsonify(resp_dict)
+
+    @app.route("/quizzes/sessions", methods=["POST"])
+    def start_quiz_session():
+        """Start a quiz session with a pre-drawn order of questions, or an
+        adaptive one whose questions follow the player's score."""
+        body = request.get_json(silent=True) or {}
+        try:
+            quiz_category_id = int(
+                (body.get("quiz_category") or {}).get("id") or 0
+            )
+            length = int(body.get("length", QUESTIONS_PER_QUIZ))
+        except (AttributeError, TypeError, ValueError) as e:
+            app.logger.warning(e)
+            abort(422)
+        if not 0 < length <= MAX_QUESTIONS_PER_QUIZ:
+            abort(422)
+        if quiz_category_id and quiz_category_id not in category_cache.get():
+            abort(404)
+
+        if body.get("adaptive"):
+            length = min(
+                length, question_sampler.count(quiz_category_id or None)
+            )
+            session_id = start_adaptive_session(
+                quiz_sessions, quiz_category_id or None, length
+            )
+            return jsonify(
+                {
                     "success": True,
+                    "session_id": session_id,
+                    "total_questions": length,
                 }
-                question = (
-                    random.choice(questions).format() if questions else None
+            )
+        question_ids = question_sampler.draw_ids(
+            quiz_category_id or None, length
+        )
+        session_id = start_session(quiz_sessions, question_ids)
+        return jsonify(
+            {
+                "success": True,
+                "session_id": session_id,
+                "total_questions": len(question_ids),
+            }
+        )
+
+    @app.route("/quizzes/sessions/<session_id>/next", methods=["POST"])
+    @replica_reads
+    def get_quiz_session_question(session_id):
+        """Get the next question of a quiz session.
+
+        Adaptive sessions take whether the previous question was answered
+        correctly as the boolean `correct` in the request body.
+        """
+        resp_dict = {
+            "success": True,
+        }
+        session = quiz_sessions.get(session_id)
+        if session is None:
+            abort(404)
+        if session.get("adaptive"):
+            body = request.get_json(silent=True) or {}
+            correct = body.get("correct") if isinstance(body, dict) else None
+            if correct is not None:
+                # "no" or 0 would count as correct answers otherwise
+                if not isinstance(correct, bool):
+                    abort(422)
+                record_answer(session, correct)
+            weights = next_weights(session)
+            question = None
+            if weights is not None:
+                question = question_sampler.sample_weighted(
+                    weights, session["played"]
                 )
-                if question:
-                    resp_dict["question"] = question
+            if question is not None:
+                session["played"].append(question.id)
+                resp_dict["question"] = question.format()
+            quiz_sessions.put(session_id, session)
+            resp_dict["score"] = session_score(session)
+            return jsonify(resp_dict)
+        while True:
+            try:
+                question_id = next_question_id(quiz_sessions, session_id)
+            except KeyError:
+                abort(404)
+            if question_id is None:
+                return jsonify(resp_dict)
+            question = question_sampler.get(question_id)
+            # skip questions deleted since the session was started
+            if question is not None:
+                resp_dict["question"] = question.format()
                 return jsonify(resp_dict)
 
     @app.errorhandler(404)
@@ -298,6 +624,20 @@ def create_app(test_config=None):
             422,
         )
 
+    @app.errorhandler(429)
+    def too_many_requests(error):
+        return (
+            jsonify(
+                {
+                    "success": False,
+                    "error": 429,
+                    "message": "Too Many Requests",
+                }
+            ),
+            429,
+            {"Retry-After": str(math.ceil(g.get("retry_after", 1)))},
+        )
+
     @app.errorhandler(500)
     def internal_server_error(error):
         return (
@@ -311,4 +651,18 @@ def create_app(test_config=None):
             500,
         )
 
+    @app.errorhandler(503)
+    def service_unavailable(error):
+        return (
+            jsonify(
+                {
+                    "success": False,
+                    "error": 503,
+                    "message": "Service Unavailable",
+                }
+            ),
+            503,
+            {"Retry-After": str(math.ceil(g.get("retry_after", 1)))},
+        )
+
     return app
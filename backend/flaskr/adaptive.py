@@ -0,0 +1,94 @@
+import secrets
+
+DIFFICULTIES = (1, 2, 3, 4, 5)
+
+
+def target_difficulty(correct, answered):
+    """Difficulty matching a player's running score.
+
+    The share of correct answers is smoothed, so a new player starts in the
+    middle and a single answer moves the target by at most one step.
+    """
+    accuracy = (correct + 1) / (answered + 2)
+    return DIFFICULTIES[round(accuracy * (len(DIFFICULTIES) - 1))]
+
+
+def difficulty_weights(target):
+    """Draw weights of the difficulties, halving with every step away from
+    `target`."""
+    return {
+        difficulty: 2.0 ** -abs(difficulty - target)
+        for difficulty in DIFFICULTIES
+    }
+
+
+def bucket_weights(categories, weights):
+    """Draw weights of the `(category, difficulty)` buckets of a
+    `QuestionIdIndex`.
+
+    `categories` is a category id, None for all categories, or a mapping of
+    category ids to weights, and `weights` maps difficulties to weights.
+    The weight of a bucket is the product of both.
+    """
+    if not isinstance(categories, dict):
+        categories = {categories: 1.0}
+    return {
+        (category, difficulty): category_weight * weight
+        for category, category_weight in categories.items()
+        for difficulty, weight in weights.items()
+    }
+
+
+def start_adaptive_session(store, category, length):
+    """Store a new adaptive session of `length` questions, return its id.
+
+    Unlike the sessions of `start_session`, questions are not drawn up
+    front: each one is drawn when it is asked for, from the difficulties
+    around the player's running score.
+    """
+    session_id = secrets.token_urlsafe(16)
+    store.put(
+        session_id,
+        {
+            "adaptive": True,
+            "category": category,
+            "length": length,
+            "played": [],
+            "answered": 0,
+            "correct": 0,
+        },
+    )
+    return session_id
+
+
+def record_answer(session, correct):
+    """Score the last question of `session`, only once per question.
+
+    `correct` is a bool, callers validate what clients send.
+    """
+    if session["answered"] < len(session["played"]):
+        session["answered"] += 1
+        session["correct"] += correct
+
+
+def next_weights(session):
+    """Bucket weights of the next question of `session`, None once all of
+    its questions were played."""
+    if len(session["played"]) >= session["length"]:
+        return None
+    return bucket_weights(
+        session["category"],
+        difficulty_weights(
+            target_difficulty(session["correct"], session["answered"])
+        ),
+    )
+
+
+def session_score(session):
+    return {
+        "answered": session["answered"],
+        "correct": session["correct"],
+        "difficulty": target_difficulty(
+            session["correct"], session["answered"]
+        ),
+    }
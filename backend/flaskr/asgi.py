@@ -0,0 +1,741 @@
+"""ASGI entry point serving the trivia API with the asyncpg driver.
+
+Serves the same routes and JSON contracts as the Flask app of
+`create_app`, but awaits every database round trip instead of holding a
+worker thread for it, so one process keeps many requests in flight. Run it
+with any ASGI server, e.g.
+
+    uvicorn --factory flaskr.asgi:create_asgi_app --workers 4
+
+Writes bump `table_versions` and the question counts in their transaction
+just like the model methods, so both apps can serve the same database side
+by side. Bulk import and export, NDJSON streaming, `/suggestions` and the
+HTTP and response caches are only served by the Flask app.
+"""
+
+import json
+import logging
+import os
+import re
+import time
+from urllib.parse import parse_qs
+
+from flask import Config
+
+from .adaptive import (
+    next_weights,
+    record_answer,
+    session_score,
+    start_adaptive_session,
+)
+from .pagination import decode_cursor, encode_cursor
+from .quiz import QuestionIdIndex
+from .quiz_sessions import LRUSessionStore, next_question_id, start_session
+from .serialization import QUESTION_FIELDS, dumps, format_stats
+
+try:
+    import asyncpg
+except ImportError:  # optional, only needed to serve the ASGI app
+    asyncpg = None
+
+QUESTIONS_PER_PAGE = 10
+MAX_QUESTIONS_PER_PAGE = 100
+QUESTIONS_PER_QUIZ = 5
+MAX_QUESTIONS_PER_QUIZ = 100
+
+SELECT_QUESTIONS = "SELECT {} FROM questions".format(
+    ", ".join(QUESTION_FIELDS)
+)
+
+ERROR_MESSAGES = {
+    404: "resource not found",
+    405: "method not allowed",
+    422: "Unprocessable Entity",
+    500: "Internal Server Error",
+}
+
+CORS_HEADERS = [
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-allow-headers", b"Content-Type,Authorization,true"),
+    (b"access-control-allow-methods", b"GET,PUT,POST,DELETE,OPTIONS"),
+]
+
+logger = logging.getLogger(__name__)
+
+
+class HTTPError(Exception):
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+class Request:
+    def __init__(self, scope, body):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.args = {
+            key: values[-1]
+            for key, values in parse_qs(
+                scope["query_string"].decode("latin-1")
+            ).items()
+        }
+        self.headers = {
+            key.decode("latin-1"): value.decode("latin-1")
+            for key, value in scope["headers"]
+        }
+        self.body = body
+        self.response_headers = list(CORS_HEADERS)
+
+    def arg(self, name, default=None, type=None):
+        """Like Flask's `request.args.get`, falls back to `default` when the
+        argument cannot be converted."""
+        if name not in self.args:
+            return default
+        if type is None:
+            return self.args[name]
+        try:
+            return type(self.args[name])
+        except ValueError:
+            return default
+
+    def json(self):
+        try:
+            body = json.loads(self.body or b"null")
+        except ValueError:
+            raise HTTPError(422)
+        if not isinstance(body, dict):
+            raise HTTPError(422)
+        return body
+
+    def prefers_minimal(self):
+        preferences = self.headers.get("prefer", "").replace(" ", "")
+        return "return=minimal" in preferences.split(",")
+
+    def minimal_response(self, payload):
+        self.response_headers.append(
+            (b"preference-applied", b"return=minimal")
+        )
+        return payload
+
+
+def format_records(records):
+    return [dict(zip(QUESTION_FIELDS, record)) for record in records]
+
+
+async def bump_version(connection, table_name):
+    await connection.execute(
+        "INSERT INTO table_versions (table_name, version) VALUES ($1, 1) "
+        "ON CONFLICT (table_name) "
+        "DO UPDATE SET version = table_versions.version + 1",
+        table_name,
+    )
+
+
+async def change_question_count(connection, category, difficulty, delta):
+    if delta < 0:
+        # questions being removed were counted, never insert a negative row
+        await connection.execute(
+            "UPDATE question_difficulty_counts SET count = count + $3 "
+            "WHERE category = $1 AND difficulty = $2",
+            category,
+            difficulty,
+            delta,
+        )
+        return
+    await connection.execute(
+        "INSERT INTO question_difficulty_counts (category, difficulty, count) "
+        "VALUES ($1, $2, $3) "
+        "ON CONFLICT (category, difficulty) "
+        "DO UPDATE SET count = question_difficulty_counts.count + $3",
+        category,
+        difficulty,
+        delta,
+    )
+
+
+async def question_count(connection, category=None):
+    if category is None:
+        return await connection.fetchval(
+            "SELECT coalesce(sum(count), 0) FROM question_difficulty_counts"
+        )
+    return await connection.fetchval(
+        "SELECT coalesce(sum(count), 0) FROM question_difficulty_counts "
+        "WHERE category = $1",
+        category,
+    )
+
+
+async def paginate(
+    connection, where, params, page, total=None, order="id", order_params=()
+):
+    """Async equivalent of `flaskr.pagination.paginate`.
+
+    `where` and `order` are SQL clauses, the placeholders of `order` are
+    numbered after the `params` of `where`.
+    """
+    if page < 1:
+        records = []
+    else:
+        records = await connection.fetch(
+            "{} {} ORDER BY {} LIMIT {} OFFSET {}".format(
+                SELECT_QUESTIONS,
+                where,
+                order,
+                QUESTIONS_PER_PAGE,
+                QUESTIONS_PER_PAGE * (page - 1),
+            ),
+            *params,
+            *order_params
+        )
+    if total is None:
+        if page == 1 and len(records) < QUESTIONS_PER_PAGE:
+            total = len(records)
+        else:
+            total = await connection.fetchval(
+                "SELECT count(*) FROM questions {}".format(where), *params
+            )
+    return format_records(records), total
+
+
+async def select_page(connection, request, where, params, total):
+    """Async equivalent of `flaskr.select_page`."""
+    if "after" not in request.args and "limit" not in request.args:
+        page = request.arg("page", 1, type=int)
+        questions, total = await paginate(
+            connection, where, params, page, total=total
+        )
+        return questions, total, {}
+
+    limit = request.arg("limit", QUESTIONS_PER_PAGE, type=int)
+    if not 0 < limit <= MAX_QUESTIONS_PER_PAGE:
+        raise HTTPError(422)
+    after = request.arg("after")
+    if after is not None:
+        try:
+            after = decode_cursor(after)
+        except ValueError:
+            raise HTTPError(422)
+        params = params + [after]
+        where = "{} {} id > ${}".format(
+            where, "AND" if where else "WHERE", len(params)
+        )
+    records = await connection.fetch(
+        "{} {} ORDER BY id LIMIT {}".format(
+            SELECT_QUESTIONS, where, limit + 1
+        ),
+        *params
+    )
+    next_cursor = None
+    if len(records) > limit:
+        records = records[:limit]
+        next_cursor = encode_cursor(records[-1][0])
+    return format_records(records), total, {"next_cursor": next_cursor}
+
+
+class TriviaASGI:
+    """The trivia API as an ASGI application backed by an asyncpg pool.
+
+    Categories and the quiz id index are loaded at startup and reloaded
+    after `CATEGORY_CACHE_TTL` and `QUIZ_INDEX_TTL` seconds. Writes served by
+    this app update the index right away. Everything runs on the event loop
+    of the process, so none of the shared state needs locking.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.pool = None
+        self.quiz_sessions = config.get(
+            "QUIZ_SESSION_STORE"
+        ) or LRUSessionStore(
+            max_sessions=config.get("QUIZ_SESSION_MAX", 10000),
+            ttl=config.get("QUIZ_SESSION_TTL", 3600),
+        )
+        self._categories = None
+        self._categories_loaded_at = 0.0
+        self._index = None
+        self._index_loaded_at = 0.0
+        self.routes = [
+            ("GET", r"/categories", self.get_categories),
+            ("GET", r"/questions", self.get_questions),
+            ("POST", r"/questions", self.post_new_question),
+            ("DELETE", r"/questions/(?P<question_id>\d+)", self.delete),
+            (
+                "GET",
+                r"/categories/(?P<category_id>\d+)/questions",
+                self.get_category,
+            ),
+            ("GET", r"/stats", self.get_stats),
+            ("POST", r"/quizzes", self.get_quiz_question),
+            ("POST", r"/quizzes/sessions", self.start_quiz_session),
+            (
+                "POST",
+                r"/quizzes/sessions/(?P<session_id>[^/]+)/next",
+                self.get_quiz_session_question,
+            ),
+        ]
+        self.routes = [
+            (method, re.compile(pattern + "$"), handler)
+            for method, pattern, handler in self.routes
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.handle(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.startup()
+                except Exception as e:
+                    await send(
+                        {"type": "lifespan.startup.failed", "message": str(e)}
+                    )
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def startup(self):
+        """Open the connection pool and load categories and the quiz index."""
+        if asyncpg is None:
+            raise RuntimeError("the ASGI app requires asyncpg")
+        config = self.config
+        self.pool = await asyncpg.create_pool(
+            config["SQLALCHEMY_DATABASE_URI"],
+            min_size=config.get("DB_POOL_PREWARM", 0),
+            max_size=config.get("DB_POOL_SIZE", 5)
+            + config.get("DB_MAX_OVERFLOW", 10),
+            max_inactive_connection_lifetime=config.get(
+                "DB_POOL_RECYCLE", 1800
+            ),
+            server_settings={
+                "statement_timeout": str(
+                    config.get("DB_STATEMENT_TIMEOUT_MS", 5000)
+                )
+            },
+        )
+        async with self.pool.acquire() as connection:
+            await self.refresh_categories(connection)
+            await self.refresh_index(connection)
+
+    async def shutdown(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def handle(self, scope, receive, send):
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+        request = Request(scope, body)
+
+        status, payload = 200, None
+        if request.method != "OPTIONS":
+            try:
+                handler, kwargs = self.route(request)
+                payload = await handler(request, **kwargs)
+            except Exception as e:
+                if isinstance(e, HTTPError):
+                    status = e.status
+                else:
+                    logger.exception(e)
+                    status = 500
+                payload = {
+                    "success": False,
+                    "error": status,
+                    "message": ERROR_MESSAGES[status],
+                }
+
+        content = b"" if payload is None else dumps(payload)
+        headers = request.response_headers
+        headers.append((b"content-type", b"application/json"))
+        headers.append((b"content-length", str(len(content)).encode()))
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": headers,
+            }
+        )
+        await send({"type": "http.response.body", "body": content})
+
+    def route(self, request):
+        path_found = False
+        for method, pattern, handler in self.routes:
+            match = pattern.match(request.path)
+            if match is None:
+                continue
+            if method == request.method:
+                return handler, match.groupdict()
+            path_found = True
+        raise HTTPError(405 if path_found else 404)
+
+    async def refresh_categories(self, connection):
+        records = await connection.fetch("SELECT id, type FROM categories")
+        self._categories = {record["id"]: record["type"] for record in records}
+        self._categories_loaded_at = time.monotonic()
+
+    async def refresh_index(self, connection):
+        records = await connection.fetch(
+            "SELECT id, category, difficulty FROM questions"
+        )
+        self._index = QuestionIdIndex(tuple(record) for record in records)
+        self._index_loaded_at = time.monotonic()
+
+    async def categories(self, connection):
+        ttl = self.config.get("CATEGORY_CACHE_TTL", 300)
+        if time.monotonic() - self._categories_loaded_at >= ttl:
+            await self.refresh_categories(connection)
+        return self._categories
+
+    async def index(self, connection):
+        ttl = self.config.get("QUIZ_INDEX_TTL", 300)
+        if time.monotonic() - self._index_loaded_at >= ttl:
+            await self.refresh_index(connection)
+        return self._index
+
+    async def get_categories(self, request):
+        async with self.pool.acquire() as connection:
+            categories = await self.categories(connection)
+        return {
+            "success": True,
+            "categories": categories,
+            "total_categories": len(categories),
+        }
+
+    async def get_stats(self, request):
+        async with self.pool.acquire() as connection:
+            categories = await self.categories(connection)
+            records = await connection.fetch(
+                "SELECT category, difficulty, count "
+                "FROM question_difficulty_counts WHERE count > 0 "
+                "ORDER BY category, difficulty"
+            )
+        return format_stats(categories, [tuple(r) for r in records])
+
+    async def get_questions(self, request):
+        async with self.pool.acquire() as connection:
+            categories = await self.categories(connection)
+            questions, total_questions, cursor = await select_page(
+                connection,
+                request,
+                "",
+                [],
+                total=await question_count(connection),
+            )
+        if not questions:
+            raise HTTPError(404)
+        return {
+            "success": True,
+            "questions": questions,
+            "total_questions": total_questions,
+            "categories": categories,
+            "current_category": categories[questions[0]["category"]],
+            **cursor,
+        }
+
+    async def get_category(self, request, category_id):
+        category_id = int(category_id)
+        async with self.pool.acquire() as connection:
+            categories = await self.categories(connection)
+            if category_id not in categories:
+                raise HTTPError(404)
+            questions, total_questions, cursor = await select_page(
+                connection,
+                request,
+                "WHERE category = $1",
+                [category_id],
+                total=await question_count(connection, category_id),
+            )
+        return {
+            "success": True,
+            "questions": questions,
+            "total_questions": total_questions,
+            "current_category": categories[category_id],
+            **cursor,
+        }
+
+    async def delete(self, request, question_id):
+        question_id = int(question_id)
+        page = request.arg("page", 1, type=int)
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                deleted = await connection.fetchrow(
+                    "DELETE FROM questions WHERE id = $1 "
+                    "RETURNING category, difficulty",
+                    question_id,
+                )
+                if deleted is None:
+                    raise HTTPError(404)
+                await bump_version(connection, "questions")
+                await change_question_count(
+                    connection, deleted["category"], deleted["difficulty"], -1
+                )
+            if self._index is not None:
+                self._index.remove(question_id)
+            if request.prefers_minimal():
+                return request.minimal_response(
+                    {"success": True, "deleted": question_id}
+                )
+            questions, total_questions = await paginate(
+                connection,
+                "",
+                [],
+                page,
+                total=await question_count(connection),
+            )
+        return {
+            "success": True,
+            "deleted": question_id,
+            "total_questions": total_questions,
+            "questions": questions,
+        }
+
+    async def post_new_question(self, request):
+        body = request.json()
+        if body.get("searchTerm"):
+            return await self.search_question(request, body)
+
+        page = request.arg("page", 1, type=int)
+        async with self.pool.acquire() as connection:
+            try:
+                values = (
+                    body["question"],
+                    body["answer"],
+                    int(body["category"]),
+                    int(body["difficulty"]),
+                )
+            except (KeyError, TypeError, ValueError):
+                raise HTTPError(422)
+            if values[2] not in await self.categories(connection):
+                raise HTTPError(422)
+
+            async with connection.transaction():
+                question_id = await connection.fetchval(
+                    "INSERT INTO questions "
+                    "(question, answer, category, difficulty) "
+                    "VALUES ($1, $2, $3, $4) RETURNING id",
+                    *values
+                )
+                await bump_version(connection, "questions")
+                await change_question_count(
+                    connection, values[2], values[3], 1
+                )
+            if self._index is not None:
+                self._index.add(question_id, values[2], values[3])
+            if request.prefers_minimal():
+                return request.minimal_response(
+                    {"success": True, "created": question_id}
+                )
+            questions, total_questions = await paginate(
+                connection,
+                "",
+                [],
+                page,
+                total=await question_count(connection),
+            )
+        return {
+            "success": True,
+            "questions": questions,
+            "total_questions": total_questions,
+            "created": question_id,
+        }
+
+    async def search_question(self, request, body):
+        """Async equivalent of `flaskr.search.search_questions`."""
+        page = request.arg("page", 1, type=int)
+        search_term = str(body["searchTerm"]).lower()
+        async with self.pool.acquire() as connection:
+            categories = await self.categories(connection)
+            questions, total_questions = await paginate(
+                connection,
+                "WHERE question ILIKE $1",
+                ["%{}%".format(search_term)],
+                page,
+                order="word_similarity($2, question) DESC, id",
+                order_params=[search_term],
+            )
+        current_category = None
+        if questions:
+            current_category = categories[questions[0]["category"]]
+        return {
+            "success": True,
+            "questions": questions,
+            "total_questions": total_questions,
+            "current_category": current_category,
+        }
+
+    async def get_quiz_question(self, request):
+        body = request.json()
+        try:
+            previous_questions = {int(i) for i in body["previous_questions"]}
+            quiz_category_id = (
+                int((body.get("quiz_category") or {}).get("id") or 0) or None
+            )
+            count = body.get("count")
+            if count is not None:
+                count = int(count)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            raise HTTPError(422)
+        if count is not None and not 0 < count <= MAX_QUESTIONS_PER_QUIZ:
+            raise HTTPError(422)
+
+        resp_dict = {"success": True}
+        async with self.pool.acquire() as connection:
+            index = await self.index(connection)
+            if count is not None:
+                resp_dict["questions"] = await self.sample_many(
+                    connection,
+                    index,
+                    quiz_category_id,
+                    previous_questions,
+                    count,
+                )
+                return resp_dict
+            while True:
+                question_id = index.sample_id(
+                    quiz_category_id, previous_questions
+                )
+                if question_id is None:
+                    return resp_dict
+                question = await connection.fetchrow(
+                    SELECT_QUESTIONS + " WHERE id = $1", question_id
+                )
+                if question is not None:
+                    resp_dict["question"] = dict(question)
+                    return resp_dict
+                # deleted by another process since the index was loaded
+                index.remove(question_id)
+
+    async def sample_many(self, connection, index, category, excluded, count):
+        """Async equivalent of `QuestionSampler.sample_many`."""
+        questions = []
+        while len(questions) < count:
+            question_ids = index.sample_ids(
+                category, excluded, count - len(questions)
+            )
+            if not question_ids:
+                break
+            records = await connection.fetch(
+                SELECT_QUESTIONS + " WHERE id = ANY($1)", question_ids
+            )
+            rows = {record[0]: record for record in records}
+            for question_id in question_ids:
+                if question_id in rows:
+                    questions.append(rows[question_id])
+                else:
+                    index.remove(question_id)
+            excluded = excluded | set(question_ids)
+        return format_records(questions)
+
+    async def start_quiz_session(self, request):
+        body = request.json() if request.body else {}
+        try:
+            quiz_category_id = int(
+                (body.get("quiz_category") or {}).get("id") or 0
+            )
+            length = int(body.get("length", QUESTIONS_PER_QUIZ))
+        except (AttributeError, TypeError, ValueError):
+            raise HTTPError(422)
+        if not 0 < length <= MAX_QUESTIONS_PER_QUIZ:
+            raise HTTPError(422)
+        async with self.pool.acquire() as connection:
+            if quiz_category_id and quiz_category_id not in (
+                await self.categories(connection)
+            ):
+                raise HTTPError(404)
+            index = await self.index(connection)
+        if body.get("adaptive"):
+            length = min(length, index.count(quiz_category_id or None))
+            session_id = start_adaptive_session(
+                self.quiz_sessions, quiz_category_id or None, length
+            )
+            return {
+                "success": True,
+                "session_id": session_id,
+                "total_questions": length,
+            }
+        question_ids = index.draw_ids(quiz_category_id or None, length)
+        session_id = start_session(self.quiz_sessions, question_ids)
+        return {
+            "success": True,
+            "session_id": session_id,
+            "total_questions": len(question_ids),
+        }
+
+    async def get_quiz_session_question(self, request, session_id):
+        resp_dict = {"success": True}
+        session = self.quiz_sessions.get(session_id)
+        if session is None:
+            raise HTTPError(404)
+        if session.get("adaptive"):
+            return await self.get_adaptive_question(
+                request, session_id, session
+            )
+        async with self.pool.acquire() as connection:
+            while True:
+                try:
+                    question_id = next_question_id(
+                        self.quiz_sessions, session_id
+                    )
+                except KeyError:
+                    raise HTTPError(404)
+                if question_id is None:
+                    return resp_dict
+                question = await connection.fetchrow(
+                    SELECT_QUESTIONS + " WHERE id = $1", question_id
+                )
+                # skip questions deleted since the session was started
+                if question is not None:
+                    resp_dict["question"] = dict(question)
+                    return resp_dict
+
+    async def get_adaptive_question(self, request, session_id, session):
+        body = request.json() if request.body else {}
+        correct = body.get("correct")
+        if correct is not None:
+            if not isinstance(correct, bool):
+                raise HTTPError(422)
+            record_answer(session, correct)
+        resp_dict = {"success": True}
+        weights = next_weights(session)
+        if weights is not None:
+            async with self.pool.acquire() as connection:
+                index = await self.index(connection)
+                while True:
+                    question_id = index.sample_weighted_id(
+                        weights, set(session["played"])
+                    )
+                    if question_id is None:
+                        break
+                    question = await connection.fetchrow(
+                        SELECT_QUESTIONS + " WHERE id = $1", question_id
+                    )
+                    if question is not None:
+                        session["played"].append(question_id)
+                        resp_dict["question"] = dict(question)
+                        break
+                    # deleted by another process since the index was loaded
+                    index.remove(question_id)
+        self.quiz_sessions.put(session_id, session)
+        resp_dict["score"] = session_score(session)
+        return resp_dict
+
+
+def create_asgi_app(test_config=None):
+    """Create the ASGI app, configured like `create_app`."""
+    config = Config(os.path.dirname(os.path.abspath(__file__)))
+    if test_config is None:
+        config.from_pyfile("config.py", silent=True)
+    else:
+        config.from_mapping(test_config)
+    return TriviaASGI(config)
@@ -0,0 +1,190 @@
+import csv
+import io
+import json
+from collections import Counter
+
+import click
+from flask import current_app
+
+from models import (
+    Question,
+    bump_version,
+    change_question_count,
+    db,
+    notify_reload,
+)
+
+from .serialization import QUESTION_FIELDS
+from .streaming import iter_ndjson, iter_rows
+
+IMPORT_BATCH_SIZE = 1000
+# errors reported back at most, the rest is only counted
+MAX_REPORTED_ERRORS = 100
+COLUMNS = ("question", "answer", "category", "difficulty")
+FORMATS = ("ndjson", "csv")
+
+
+def read_rows(lines, format_):
+    """Yield (line number, row dict) for every record of `lines`."""
+    if format_ == "csv":
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        for line_number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                row = e
+            yield line_number, row
+
+
+def parse_integer(value):
+    """`value` as an int, for integers and their decimal string form as
+    read from CSV, raise ValueError otherwise."""
+    # bool is an int subclass, true would be read as category 1
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(value)
+    return int(value)
+
+
+def validate_row(row, categories):
+    """Return the question columns of `row`, raise ValueError if invalid."""
+    if isinstance(row, Exception):
+        raise ValueError("invalid json: {}".format(row))
+    if not isinstance(row, dict):
+        raise ValueError("expected an object")
+    for column in COLUMNS:
+        # a short CSV line fills the missing fields with None
+        if row.get(column) is None:
+            raise ValueError("missing '{}'".format(column))
+    if not isinstance(row["question"], str) or not isinstance(
+        row["answer"], str
+    ):
+        raise ValueError("question and answer must be strings")
+    try:
+        question = {
+            "question": row["question"].strip(),
+            "answer": row["answer"].strip(),
+            "category": parse_integer(row["category"]),
+            "difficulty": parse_integer(row["difficulty"]),
+        }
+    except ValueError:
+        raise ValueError("category and difficulty must be integers")
+    if not question["question"] or not question["answer"]:
+        raise ValueError("question and answer must not be empty")
+    if question["category"] not in categories:
+        raise ValueError("unknown category {}".format(question["category"]))
+    return question
+
+
+def load_batch(rows):
+    """Insert validated rows, with COPY on Postgres, in the open transaction."""
+    connection = db.session.connection()
+    if connection.dialect.driver == "psycopg2":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([row[column] for column in COLUMNS])
+        buffer.seek(0)
+        cursor = connection.connection.cursor()
+        cursor.copy_expert(
+            "COPY questions ({}) FROM STDIN WITH (FORMAT csv)".format(
+                ", ".join(COLUMNS)
+            ),
+            buffer,
+        )
+    else:
+        db.session.execute(Question.__table__.insert(), rows)
+
+
+def import_questions(lines, format_, batch_size=IMPORT_BATCH_SIZE):
+    """Validate and load the questions of `lines` in batches.
+
+    Every batch is loaded in its own transaction, invalid rows are skipped
+    and reported with their line number. Returns a summary of the import.
+    """
+    categories = current_app.extensions["category_cache"].get()
+    summary = {"imported": 0, "rejected": 0, "errors": []}
+    batch = []
+
+    def flush():
+        load_batch(batch)
+        bump_version(Question.__tablename__)
+        for (category, difficulty), count in Counter(
+            (row["category"], row["difficulty"]) for row in batch
+        ).items():
+            change_question_count(category, difficulty, count)
+        db.session.commit()
+        summary["imported"] += len(batch)
+        batch.clear()
+
+    try:
+        for line_number, row in read_rows(lines, format_):
+            try:
+                batch.append(validate_row(row, categories))
+            except ValueError as e:
+                summary["rejected"] += 1
+                if len(summary["errors"]) < MAX_REPORTED_ERRORS:
+                    summary["errors"].append(
+                        {"line": line_number, "error": str(e)}
+                    )
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+    finally:
+        db.session.rollback()
+        if summary["imported"]:
+            notify_reload(Question)
+    return summary
+
+
+def export_questions(format_):
+    """Yield all questions in `format_`, reading them with a server-side
+    cursor so memory use does not depend on the size of the table."""
+    if format_ != "csv":
+        yield from iter_ndjson(Question.query)
+        return
+    # csv is written as text, ndjson as bytes
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(QUESTION_FIELDS)
+    for row in iter_rows(Question.query):
+        writer.writerow(row)
+        if buffer.tell() >= 64 * 1024:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def register_bulk_commands(app):
+    @app.cli.command("import-questions")
+    @click.argument("path", type=click.Path(exists=True, dir_okay=False))
+    @click.option("--format", "format_", type=click.Choice(FORMATS))
+    def import_questions_command(path, format_):
+        """Import questions from an NDJSON or CSV file."""
+        format_ = format_ or ("csv" if path.endswith(".csv") else "ndjson")
+        with open(path, newline="", encoding="utf-8") as lines:
+            summary = import_questions(lines, format_)
+        for error in summary["errors"]:
+            click.echo("line {line}: {error}".format(**error), err=True)
+        click.echo(
+            "imported {imported}, rejected {rejected}".format(**summary)
+        )
+
+    @app.cli.command("export-questions")
+    @click.argument("path", type=click.Path(dir_okay=False, writable=True))
+    @click.option("--format", "format_", type=click.Choice(FORMATS))
+    def export_questions_command(path, format_):
+        """Export all questions to an NDJSON or CSV file."""
+        format_ = format_ or ("csv" if path.endswith(".csv") else "ndjson")
+        with open(path, "wb") as out:
+            for chunk in export_questions(format_):
+                # csv chunks are text, ndjson chunks bytes
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                out.write(chunk)
@@ -0,0 +1,71 @@
+import threading
+import time
+
+from models import Category
+
+from .replicas import read_primary
+from .response_cache import current_versions
+
+
+class CategoryCache:
+    """Process-local cache of the `{id: type}` mapping of all categories.
+
+    The categories are reloaded once another process bumped the version of
+    the categories table, so views cached under that version never see the
+    categories it replaced. Entries also expire after `ttl` seconds, so
+    categories added directly in the database show up eventually. Writes
+    through `Category` invalidate the cache right away when it is
+    registered as a write listener.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._categories = None
+        self._version = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return the cached categories, reloading them once expired or
+        written by another process."""
+        (version,) = current_versions(Category.__tablename__)
+        with self._lock:
+            if (
+                self._categories is not None
+                and self._version == version
+                and time.monotonic() - self._loaded_at < self.ttl
+            ):
+                self.hits += 1
+                return self._categories
+            self.misses += 1
+        return self.refresh()
+
+    def refresh(self):
+        """Load all categories from the database into the cache."""
+        # read before the categories, a write in between reloads them again
+        (version,) = current_versions(Category.__tablename__)
+        # from the primary, a lagging replica would be cached for `ttl`
+        with read_primary():
+            categories = {
+                category.id: category.type for category in Category.query.all()
+            }
+        with self._lock:
+            self._categories = categories
+            self._version = version
+            self._loaded_at = time.monotonic()
+        return categories
+
+    def invalidate(self, *args):
+        """Drop the cached categories, accepts write listener arguments."""
+        with self._lock:
+            self._categories = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._categories or {}),
+            }
@@ -15,5 +15,56 @@ DATABASE = "trivia"
 DB_PORT = 5432
 
 # sql alchemy
-SQLALCHEMY_DATABASE_URI = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DATABASE}"
+SQLALCHEMY_DATABASE_URI = (
+    f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DATABASE}"
+)
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+# connection pool, sized against postgres max_connections:
+# workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) should stay below it
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", 10))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_POOL_PREWARM = int(os.environ.get("DB_POOL_PREWARM", DB_POOL_SIZE))
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 5000))
+SQLALCHEMY_ENGINE_OPTIONS = {
+    "pool_size": DB_POOL_SIZE,
+    "max_overflow": DB_MAX_OVERFLOW,
+    "pool_timeout": DB_POOL_TIMEOUT,
+    "pool_recycle": DB_POOL_RECYCLE,
+    "pool_pre_ping": DB_POOL_PRE_PING,
+    "connect_args": {
+        "options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+    },
+}
+# read replicas serving the reads of listings, search and quizzes,
+# comma separated database URIs
+SQLALCHEMY_REPLICA_URIS = [
+    uri for uri in os.environ.get("DB_REPLICA_URIS", "").split(",") if uri
+]
+REPLICA_RETRY_AFTER = int(os.environ.get("DB_REPLICA_RETRY_AFTER", 30))
+REPLICA_STICKY_SECONDS = int(os.environ.get("DB_REPLICA_STICKY_SECONDS", 5))
+# rate limits per client as (requests per second, burst) and concurrent
+# requests per worker, keyed by "METHOD /rule"
+RATE_LIMITS = {
+    "POST /questions": (5, 20),
+    "POST /quizzes": (10, 30),
+}
+CONCURRENCY_LIMITS = {
+    "POST /questions": 8,
+}
+# off for load tests, e.g. LIMITS_ENABLED=false
+LIMITS_ENABLED = os.environ.get("LIMITS_ENABLED", "true").lower() == "true"
+# reverse proxies in front of the app setting X-Forwarded-For
+PROXY_FIX_X_FOR = int(os.environ.get("PROXY_FIX_X_FOR", 0))
+# limited routes answer 503 while this fraction of the pool is in use
+POOL_SATURATION_THRESHOLD = float(
+    os.environ.get("POOL_SATURATION_THRESHOLD", 0.9)
+)
+# SQLite file sharing the rate limits between the workers of a node
+RATE_LIMIT_STORE = os.environ.get("RATE_LIMIT_STORE")
+# worker startup: tables are created by `flask init-db` on deploy rather
+# than checked by every worker, indexes load on boot or on first use
+DB_CREATE_ALL = os.environ.get("DB_CREATE_ALL", "false").lower() == "true"
+PRELOAD_INDEXES = os.environ.get("PRELOAD_INDEXES", "true").lower() == "true"
@@ -0,0 +1,43 @@
+import functools
+
+from flask import current_app, make_response, request
+
+from .response_cache import current_versions
+
+
+def conditional(*table_names):
+    """Answer conditional GET requests of a view from table versions.
+
+    The response of the decorated view must only depend on the request and
+    the content of `table_names`. Its ETag is derived from the versions of
+    those tables, so a matching If-None-Match is answered with 304 without
+    running the view. Cache-Control lets clients and proxies store the
+    response, revalidating it after HTTP_CACHE_MAX_AGE seconds.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            versions = current_versions(*table_names)
+            etag = "-".join(
+                "{}{}".format(table_name[0], version)
+                for table_name, version in zip(table_names, versions)
+            )
+            if request.if_none_match.contains_weak(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            response.vary.add("Accept")
+            max_age = current_app.config.get("HTTP_CACHE_MAX_AGE", 0)
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+            if not max_age:
+                response.cache_control.no_cache = True
+            return response
+
+        return wrapper
+
+    return decorator
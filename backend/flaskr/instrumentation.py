@@ -0,0 +1,295 @@
+import threading
+import time
+
+from flask import current_app, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import db
+
+from .metrics import Histogram
+from .pool import pool_stats
+
+# upper bounds of the request histograms
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+# statements kept per request for the slow request log
+MAX_LOGGED_STATEMENTS = 50
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# stats of the app's components exported as counters rather than gauges
+COUNTER_STATS = {
+    "hits",
+    "misses",
+    "reads",
+    "fallbacks",
+    "limited",
+    "shed",
+    "store_errors",
+}
+
+_current = threading.local()
+
+
+class RequestStats:
+    """What a single request spent its time on."""
+
+    def __init__(self):
+        self.route = "unmatched"
+        self.status = ""
+        self.size = 0
+        self.statements = 0
+        self.db_time = 0.0
+        self.logged_statements = []
+        self.started_at = time.perf_counter()
+
+    def add_statement(self, statement, duration):
+        self.statements += 1
+        self.db_time += duration
+        if len(self.logged_statements) < MAX_LOGGED_STATEMENTS:
+            self.logged_statements.append((duration, statement))
+
+
+def current_stats():
+    """The `RequestStats` of the request served by this thread, if any."""
+    return getattr(_current, "stats", None)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_statement_timer(conn, cursor, statement, parameters, context, many):
+    conn.info["statement_started_at"] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_statement(conn, cursor, statement, parameters, context, many):
+    stats = current_stats()
+    if stats is not None:
+        started_at = conn.info.pop("statement_started_at", None)
+        if started_at is not None:
+            stats.add_statement(statement, time.perf_counter() - started_at)
+
+
+class RequestMetrics:
+    """Histograms of the requests served, per route and method."""
+
+    def __init__(self):
+        self.durations = {}
+        self.statements = {}
+        self.db_times = {}
+        self.sizes = {}
+        self.responses = {}
+        self._lock = threading.Lock()
+
+    def record(self, method, stats):
+        key = (stats.route, method)
+        with self._lock:
+            if key not in self.durations:
+                self.durations[key] = Histogram(DURATION_BUCKETS)
+                self.statements[key] = Histogram(STATEMENT_BUCKETS)
+                self.db_times[key] = Histogram(DURATION_BUCKETS)
+                self.sizes[key] = Histogram(SIZE_BUCKETS)
+            status_key = key + (stats.status,)
+            self.responses[status_key] = self.responses.get(status_key, 0) + 1
+        self.durations[key].observe(time.perf_counter() - stats.started_at)
+        self.statements[key].observe(stats.statements)
+        self.db_times[key].observe(stats.db_time)
+        self.sizes[key].observe(stats.size)
+
+    def snapshot(self):
+        """Snapshots of the histograms per metric name and the response
+        counts, both keyed by Prometheus label tuples."""
+        with self._lock:
+            histograms = {
+                "trivia_request_duration_seconds": dict(self.durations),
+                "trivia_request_sql_statements": dict(self.statements),
+                "trivia_request_db_seconds": dict(self.db_times),
+                "trivia_response_size_bytes": dict(self.sizes),
+            }
+            responses = dict(self.responses)
+        snapshots = {
+            name: {
+                (("route", route), ("method", method)): histogram.snapshot()
+                for (route, method), histogram in series.items()
+            }
+            for name, series in histograms.items()
+        }
+        responses = {
+            (("route", route), ("method", method), ("status", status)): count
+            for (route, method, status), count in responses.items()
+        }
+        return snapshots, responses
+
+
+class InstrumentedApp:
+    """WSGI middleware recording the duration, SQL statements, database time
+    and response size of every request, including streamed responses.
+
+    Requests taking `slow_seconds` or longer are logged as warnings together
+    with their slowest SQL statements.
+    """
+
+    def __init__(self, app, metrics, slow_seconds):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self.metrics = metrics
+        self.slow_seconds = slow_seconds
+
+    def __call__(self, environ, start_response):
+        stats = RequestStats()
+        _current.stats = stats
+
+        def record_status(status, headers, exc_info=None):
+            stats.status = status.split(" ", 1)[0]
+            return start_response(status, headers, exc_info)
+
+        try:
+            body = self.wsgi_app(environ, record_status)
+        except Exception:
+            _current.stats = None
+            raise
+        return self._iterate(body, stats, environ)
+
+    def _iterate(self, body, stats, environ):
+        try:
+            for chunk in body:
+                stats.size += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+            _current.stats = None
+            self._finish(stats, environ)
+
+    def _finish(self, stats, environ):
+        method = environ.get("REQUEST_METHOD", "GET")
+        self.metrics.record(method, stats)
+        duration = time.perf_counter() - stats.started_at
+        if duration < self.slow_seconds:
+            return
+        slowest = sorted(stats.logged_statements, reverse=True)[:5]
+        self.app.logger.warning(
+            "slow request %s %s took %.3fs, %d SQL statements in %.3fs%s",
+            method,
+            environ.get("PATH_INFO"),
+            duration,
+            stats.statements,
+            stats.db_time,
+            "".join(
+                "\n  {:.3f}s {}".format(seconds, " ".join(statement.split()))
+                for seconds, statement in slowest
+            ),
+        )
+
+
+def configure_instrumentation(app):
+    """Record metrics of every request served by `app`, see `render_metrics`.
+
+    Requests slower than SLOW_REQUEST_SECONDS are logged with their SQL.
+    """
+    metrics = RequestMetrics()
+    app.extensions["request_metrics"] = metrics
+    app.wsgi_app = InstrumentedApp(
+        app, metrics, slow_seconds=app.config.get("SLOW_REQUEST_SECONDS", 0.5)
+    )
+    app.before_request(label_route)
+    return metrics
+
+
+def label_route():
+    """Record the rule of the matched route, keeps the label set small."""
+    stats = current_stats()
+    if stats is not None and request.url_rule is not None:
+        stats.route = request.url_rule.rule
+
+
+def histogram_lines(name, snapshots):
+    """Prometheus text lines of histogram snapshots keyed by label tuples."""
+    lines = ["# TYPE {} histogram".format(name)]
+    for labels, snapshot in sorted(snapshots.items()):
+        for bound, count in snapshot["buckets"]:
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            lines.append(
+                "{}_bucket{} {}".format(
+                    name, format_labels(labels + (("le", le),)), count
+                )
+            )
+        lines.append(
+            "{}_sum{} {}".format(
+                name, format_labels(labels), repr(snapshot["sum"])
+            )
+        )
+        lines.append(
+            "{}_count{} {}".format(
+                name, format_labels(labels), snapshot["count"]
+            )
+        )
+    return lines
+
+
+def sample_lines(name, type_, samples):
+    """Prometheus text lines of a counter or gauge keyed by label tuples."""
+    lines = ["# TYPE {} {}".format(name, type_)]
+    for labels, value in sorted(samples.items()):
+        lines.append("{}{} {}".format(name, format_labels(labels), value))
+    return lines
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                key, str(value).replace("\\", "\\\\").replace('"', '\\"')
+            )
+            for key, value in labels
+        )
+    )
+
+
+def render_metrics():
+    """All metrics of the current app in the Prometheus text format."""
+    snapshots, responses = current_app.extensions["request_metrics"].snapshot()
+    lines = []
+    for name, series in snapshots.items():
+        lines.extend(histogram_lines(name, series))
+    lines.extend(sample_lines("trivia_responses_total", "counter", responses))
+
+    pool = pool_stats(db.engine)
+    if "checkout_wait" in pool:
+        lines.extend(
+            histogram_lines(
+                "trivia_db_pool_checkout_wait_seconds",
+                {(): pool["checkout_wait"]},
+            )
+        )
+    if "checked_out" in pool:
+        lines.extend(
+            sample_lines(
+                "trivia_db_pool_checked_out",
+                "gauge",
+                {(): pool["checked_out"]},
+            )
+        )
+
+    # hit and miss style counters of the caches, replicas and limiter, the
+    # other stats are gauges
+    for extension in (
+        "category_cache",
+        "response_cache",
+        "read_replicas",
+        "rate_limiter",
+    ):
+        component = current_app.extensions.get(extension)
+        if component is None:
+            continue
+        for key, value in sorted(component.stats().items()):
+            if key in COUNTER_STATS:
+                name, type_ = "trivia_{}_{}_total", "counter"
+            else:
+                name, type_ = "trivia_{}_{}", "gauge"
+            lines.extend(
+                sample_lines(name.format(extension, key), type_, {(): value})
+            )
+    return "\n".join(lines) + "\n"
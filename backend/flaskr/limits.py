@@ -0,0 +1,276 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from flask import abort, current_app, g, request
+
+from models import db
+
+from .pool import pool_saturation
+
+logger = logging.getLogger(__name__)
+
+# client buckets kept in memory, the least recently used are forgotten
+MAX_BUCKETS = 100000
+# seconds after which idle buckets are removed from the shared store
+SHARED_BUCKET_TTL = 3600
+
+
+def refill(tokens, updated_at, now, rate, burst):
+    """Tokens of a bucket last updated at `updated_at`, refilled by `rate`
+    tokens per second up to `burst`."""
+    return min(burst, tokens + max(0.0, now - updated_at) * rate)
+
+
+def take_token(tokens, rate):
+    """Take a token from a bucket holding `tokens`.
+
+    Returns the tokens left, and the seconds until a token is available if
+    the bucket is empty.
+    """
+    if tokens >= 1:
+        return tokens - 1, 0.0
+    return tokens, (1 - tokens) / rate
+
+
+class MemoryLimitStore:
+    """Token buckets of the clients in process memory.
+
+    Every worker process enforces its own limits, so the effective limit of
+    a node grows with the number of workers.
+    """
+
+    def __init__(self, max_buckets=MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst):
+        """Take a token of the bucket `key`, return the seconds to wait
+        before retrying or 0 if the request may proceed."""
+        now = time.time()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (burst, now))
+            tokens, retry_after = take_token(
+                refill(tokens, updated_at, now, rate, burst), rate
+            )
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+
+class LimitStoreError(Exception):
+    """A shared limit store failed to take a token."""
+
+
+class SQLiteLimitStore:
+    """Token buckets shared by the workers of one node in a SQLite file.
+
+    Every token is taken in an immediate transaction, which serializes the
+    workers on the file's write lock. Buckets idle for SHARED_BUCKET_TTL
+    seconds are removed now and then.
+    """
+
+    def __init__(self, path, timeout=1.0):
+        # imported on first use, only shared stores need it
+        import sqlite3
+
+        self._sqlite3 = sqlite3
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._takes = 0
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS rate_limit_buckets ("
+                "key TEXT PRIMARY KEY, tokens REAL, updated_at REAL)"
+            )
+
+    def _connect(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def take(self, key, rate, burst):
+        try:
+            return self._take(key, rate, burst)
+        except self._sqlite3.Error as e:
+            raise LimitStoreError(e) from e
+
+    def _take(self, key, rate, burst):
+        now = time.time()
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT tokens, updated_at FROM rate_limit_buckets "
+                "WHERE key = ?",
+                (key,),
+            ).fetchone()
+            tokens, updated_at = row or (burst, now)
+            tokens, retry_after = take_token(
+                refill(tokens, updated_at, now, rate, burst), rate
+            )
+            connection.execute(
+                "INSERT OR REPLACE INTO rate_limit_buckets "
+                "VALUES (?, ?, ?)",
+                (key, tokens, now),
+            )
+            self._takes += 1
+            if self._takes % 1000 == 0:
+                connection.execute(
+                    "DELETE FROM rate_limit_buckets WHERE updated_at < ?",
+                    (now - SHARED_BUCKET_TTL,),
+                )
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        return retry_after
+
+
+class Limiter:
+    """Rate limits per route and client, concurrency limits per route and
+    load shedding when the database pool is saturated.
+
+    `rate_limits` maps routes such as "POST /questions" to a (rate, burst)
+    pair: each client may send `burst` requests at once and `rate` requests
+    per second on average. `concurrency_limits` maps routes to the number of
+    requests a worker serves at the same time, further requests fail
+    right away rather than queueing for a worker and a connection. Limited
+    routes also fail while at least `pool_threshold` of the connection
+    pool is checked out.
+    """
+
+    def __init__(self, store, rate_limits, concurrency_limits, pool_threshold):
+        self.store = store
+        self.rate_limits = rate_limits
+        self.concurrency_limits = concurrency_limits
+        self.pool_threshold = pool_threshold
+        self.limited = 0
+        self.shed = 0
+        self.store_errors = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def check_rate(self, route, client):
+        """Seconds the client has to wait before calling `route` again, 0 if
+        it may call it now."""
+        if route not in self.rate_limits:
+            return 0.0
+        rate, burst = self.rate_limits[route]
+        try:
+            retry_after = self.store.take(
+                "{} {}".format(route, client), rate, burst
+            )
+        except LimitStoreError as e:
+            # let requests through rather than failing on the store
+            logger.warning("rate limit store failed: %s", e)
+            self.store_errors += 1
+            return 0.0
+        if retry_after:
+            self.limited += 1
+        return retry_after
+
+    def acquire(self, route):
+        """Count a request of `route` as in flight, False if it is over the
+        route's concurrency limit or the pool is saturated."""
+        limit = self.concurrency_limits.get(route)
+        if limit is None and route not in self.rate_limits:
+            return True
+        saturation = pool_saturation(db.engine)
+        if saturation is not None and saturation >= self.pool_threshold:
+            self.shed += 1
+            return False
+        if limit is None:
+            return True
+        with self._lock:
+            in_flight = self._in_flight.get(route, 0)
+            if in_flight >= limit:
+                self.shed += 1
+                return False
+            self._in_flight[route] = in_flight + 1
+        return True
+
+    def release(self, route):
+        if route not in self.concurrency_limits:
+            return
+        with self._lock:
+            self._in_flight[route] -= 1
+
+    def stats(self):
+        with self._lock:
+            in_flight = sum(self._in_flight.values())
+        return {
+            "limited": self.limited,
+            "shed": self.shed,
+            "store_errors": self.store_errors,
+            "in_flight": in_flight,
+        }
+
+
+def configure_limits(app):
+    """Enforce RATE_LIMITS and CONCURRENCY_LIMITS on the app's routes.
+
+    Buckets are kept in memory unless RATE_LIMIT_STORE names a SQLite file
+    shared by the workers. Does nothing when no limit is configured or
+    LIMITS_ENABLED is off.
+
+    Clients are told apart by their address, behind a reverse proxy set
+    PROXY_FIX_X_FOR so that it is read from X-Forwarded-For, otherwise all
+    clients share the proxy's buckets.
+    """
+    if not app.config.get("LIMITS_ENABLED", True):
+        return None
+    rate_limits = app.config.get("RATE_LIMITS") or {}
+    concurrency_limits = app.config.get("CONCURRENCY_LIMITS") or {}
+    if not rate_limits and not concurrency_limits:
+        return None
+    path = app.config.get("RATE_LIMIT_STORE")
+    store = SQLiteLimitStore(path) if path else MemoryLimitStore()
+    limiter = Limiter(
+        store,
+        rate_limits=rate_limits,
+        concurrency_limits=concurrency_limits,
+        pool_threshold=app.config.get("POOL_SATURATION_THRESHOLD", 0.9),
+    )
+    app.extensions["rate_limiter"] = limiter
+    app.before_request(enforce_limits)
+    app.teardown_request(release_limits)
+    return limiter
+
+
+def route_key():
+    if request.url_rule is None:
+        return None
+    return "{} {}".format(request.method, request.url_rule.rule)
+
+
+def enforce_limits():
+    """Reject the request with 429 or 503 when it is over a limit."""
+    route = route_key()
+    if route is None:
+        return
+    limiter = current_app.extensions["rate_limiter"]
+    # shed requests first, they must not spend a token of the client
+    if not limiter.acquire(route):
+        g.retry_after = 1
+        abort(503)
+    g.limited_route = route
+    retry_after = limiter.check_rate(route, request.remote_addr)
+    if retry_after:
+        g.retry_after = retry_after
+        abort(429)
+
+
+def release_limits(exc=None):
+    route = g.pop("limited_route", None)
+    if route is not None:
+        current_app.extensions["rate_limiter"].release(route)
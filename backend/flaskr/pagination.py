@@ -0,0 +1,61 @@
+import base64
+import binascii
+
+from models import Question
+
+from .serialization import question_rows
+
+
+def paginate(query, elements_per_page, page, total=None):
+    """Fetch one page of `query` as question rows and count its matches.
+
+    The page is selected with LIMIT/OFFSET and the total with a separate
+    COUNT, so only the requested rows are ever loaded from the database.
+    Pass `total` when the number of matches is already known to skip the
+    COUNT. Questions are ordered by id to keep pages stable between
+    requests.
+    """
+    if page < 1:
+        items = []
+    else:
+        items = (
+            question_rows(query)
+            .order_by(Question.id)
+            .limit(elements_per_page)
+            .offset(elements_per_page * (page - 1))
+            .all()
+        )
+    if total is None:
+        if page == 1 and len(items) < elements_per_page:
+            total = len(items)
+        else:
+            total = query.order_by(None).count()
+    return items, total
+
+
+def encode_cursor(question_id):
+    """Turn the id of the last question on a page into an opaque cursor."""
+    return base64.urlsafe_b64encode(str(question_id).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Inverse of `encode_cursor`, raises ValueError on malformed input."""
+    try:
+        return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+    except (binascii.Error, UnicodeError) as e:
+        raise ValueError(e)
+
+
+def paginate_after(query, after, limit):
+    """Fetch up to `limit` rows of `query` with an id greater than `after`.
+
+    Uses the primary key index to seek straight to the first row of the
+    page, so deep pages cost the same as the first one. Returns the rows
+    and the cursor of the next page, which is None on the last page.
+    """
+    if after is not None:
+        query = query.filter(Question.id > after)
+    rows = question_rows(query).order_by(Question.id).limit(limit + 1).all()
+    if len(rows) > limit:
+        return rows[:limit], encode_cursor(rows[limit - 1].id)
+    return rows, None
@@ -0,0 +1,75 @@
+import logging
+import time
+
+from sqlalchemy.pool import QueuePool
+
+from .metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+# upper bounds of the checkout wait histogram in seconds
+CHECKOUT_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+SLOW_CHECKOUT_SECONDS = 0.1
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool recording how long each connection checkout waited."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkout_wait = Histogram(CHECKOUT_WAIT_BUCKETS)
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            self.checkout_wait.observe(waited)
+            if waited >= SLOW_CHECKOUT_SECONDS:
+                logger.warning(
+                    "waited %.3fs for a database connection (%s)",
+                    waited,
+                    self.status(),
+                )
+
+    def recreate(self):
+        pool = super().recreate()
+        # keep the statistics when the pool is replaced after a disconnect
+        pool.checkout_wait = self.checkout_wait
+        return pool
+
+
+def configure_pool(app):
+    """Use a `TimedQueuePool` for the app's engine unless one is configured.
+
+    SQLite keeps the pool Flask-SQLAlchemy picks for it.
+    """
+    options = dict(app.config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+    if not app.config.get("SQLALCHEMY_DATABASE_URI", "").startswith("sqlite"):
+        options.setdefault("poolclass", TimedQueuePool)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+
+
+def pool_stats(engine):
+    """Return the state of the engine's pool and its checkout wait times."""
+    pool = engine.pool
+    stats = {"status": pool.status()}
+    if isinstance(pool, QueuePool):
+        stats.update(
+            size=pool.size(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+        )
+    if hasattr(pool, "checkout_wait"):
+        stats["checkout_wait"] = pool.checkout_wait.snapshot()
+    return stats
+
+
+def pool_saturation(engine):
+    """Fraction of the pool's connections checked out, None if the pool has
+    no fixed limit."""
+    pool = engine.pool
+    if not isinstance(pool, QueuePool) or pool._max_overflow < 0:
+        return None
+    return pool.checkedout() / (pool.size() + pool._max_overflow)
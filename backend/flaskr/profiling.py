@@ -0,0 +1,280 @@
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+import click
+from itsdangerous import BadSignature, TimestampSigner
+
+from .instrumentation import current_stats
+
+# WSGI environ key of the X-Profile header
+PROFILE_HEADER = "HTTP_X_PROFILE"
+PROFILERS = ("cprofile", "sampling")
+# seconds a signed profiling token stays valid
+TOKEN_MAX_AGE = 3600
+
+
+class SamplingProfiler:
+    """Records the call stack of one thread every `interval` seconds.
+
+    Stacks are kept in the collapsed format of flamegraph.pl and speedscope:
+    one `outer;...;inner count` line per distinct stack.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self._thread_id = threading.get_ident()
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        self._sampler.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._sampler.join()
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(
+                    "{}:{}".format(
+                        frame.f_globals.get("__name__", "?"), code.co_name
+                    )
+                )
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write("{} {}\n".format(stack, count))
+
+
+class ProfilingMiddleware:
+    """WSGI middleware profiling a sample of the requests.
+
+    Profiles a PROFILE_SAMPLE_RATE fraction of all requests plus every
+    request carrying a valid signed `X-Profile` header, see
+    `profile_token`. Each capture is written to PROFILE_DIR as a pstats or
+    collapsed stacks file next to a json file with the route, duration and
+    SQL statements of the request.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.wsgi_app = app.wsgi_app
+        self.sample_rate = app.config.get("PROFILE_SAMPLE_RATE", 0.0)
+        self.profiler = app.config.get("PROFILER", "cprofile")
+        self.interval = app.config.get("PROFILE_SAMPLE_INTERVAL", 0.005)
+        self.directory = app.config.get("PROFILE_DIR") or os.path.join(
+            app.instance_path, "profiles"
+        )
+        secret = app.config.get("PROFILE_SECRET")
+        self.signer = TimestampSigner(secret) if secret else None
+
+    def __call__(self, environ, start_response):
+        if not self._should_profile(environ):
+            return self.wsgi_app(environ, start_response)
+        profiler = self._start()
+        if profiler is None:
+            return self.wsgi_app(environ, start_response)
+        started_at = time.perf_counter()
+        status = []
+
+        def record_status(status_line, headers, exc_info=None):
+            status.append(status_line.split(" ", 1)[0])
+            return start_response(status_line, headers, exc_info)
+
+        try:
+            body = self.wsgi_app(environ, record_status)
+        except Exception:
+            self._stop(profiler)
+            raise
+        return self._iterate(body, profiler, environ, status, started_at)
+
+    def _should_profile(self, environ):
+        token = environ.get(PROFILE_HEADER)
+        if token and self.signer is not None:
+            try:
+                self.signer.unsign(token, max_age=TOKEN_MAX_AGE)
+                return True
+            except BadSignature:
+                pass
+        return random.random() < self.sample_rate
+
+    def _start(self):
+        if self.profiler == "sampling":
+            profiler = SamplingProfiler(self.interval)
+            profiler.start()
+            return profiler
+        # imported on first use, most workers never profile
+        import cProfile
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another request of the process is being profiled already
+            return None
+        return profiler
+
+    def _stop(self, profiler):
+        if isinstance(profiler, SamplingProfiler):
+            profiler.stop()
+        else:
+            profiler.disable()
+
+    def _iterate(self, body, profiler, environ, status, started_at):
+        try:
+            yield from body
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+            self._stop(profiler)
+            try:
+                self._write(profiler, environ, status, started_at)
+            except OSError as e:
+                self.app.logger.warning("could not write profile: %s", e)
+
+    def _write(self, profiler, environ, status, started_at):
+        import uuid
+
+        os.makedirs(self.directory, exist_ok=True)
+        name = "{:.0f}-{}".format(time.time() * 1000, uuid.uuid4().hex[:8])
+        path = os.path.join(self.directory, name)
+        if isinstance(profiler, SamplingProfiler):
+            profile = path + ".collapsed"
+            profiler.write(profile)
+        else:
+            profile = path + ".pstats"
+            profiler.dump_stats(profile)
+        stats = current_stats()
+        capture = {
+            "method": environ.get("REQUEST_METHOD"),
+            "path": environ.get("PATH_INFO"),
+            "route": stats.route if stats else None,
+            "status": status[0] if status else None,
+            "duration": time.perf_counter() - started_at,
+            "profile": os.path.basename(profile),
+            "statements": [
+                {"seconds": seconds, "statement": statement}
+                for seconds, statement in (
+                    stats.logged_statements if stats else []
+                )
+            ],
+        }
+        with open(path + ".json", "w") as f:
+            json.dump(capture, f, indent=2)
+
+
+def configure_profiling(app):
+    """Install the `ProfilingMiddleware` if profiling is enabled.
+
+    Profiling is opt-in through PROFILE_SAMPLE_RATE or PROFILE_SECRET.
+    """
+    if not app.config.get("PROFILE_SAMPLE_RATE") and not app.config.get(
+        "PROFILE_SECRET"
+    ):
+        return None
+    if app.config.get("PROFILER", "cprofile") not in PROFILERS:
+        raise ValueError("PROFILER must be one of {}".format(PROFILERS))
+    middleware = ProfilingMiddleware(app)
+    app.wsgi_app = middleware
+    return middleware
+
+
+def profile_token(secret):
+    """A value for the `X-Profile` header, valid for TOKEN_MAX_AGE."""
+    return TimestampSigner(secret).sign("profile").decode()
+
+
+def hot_functions(captures, directory, top):
+    """Functions with the most own time per request over `captures` of one
+    route, and the innermost functions of the most sampled stacks."""
+    pstats_files = [
+        os.path.join(directory, capture["profile"])
+        for capture in captures
+        if capture["profile"].endswith(".pstats")
+    ]
+    functions = Counter()
+    if pstats_files:
+        import pstats
+
+        stats = pstats.Stats(*pstats_files)
+        for (filename, line, name), entry in stats.stats.items():
+            own_time = entry[2]
+            functions[
+                "{}:{}({})".format(filename, line, name)
+            ] += own_time / len(pstats_files)
+    samples = Counter()
+    for capture in captures:
+        if not capture["profile"].endswith(".collapsed"):
+            continue
+        with open(os.path.join(directory, capture["profile"])) as f:
+            for line in f:
+                stack, _, count = line.rstrip("\n").rpartition(" ")
+                samples[stack.rsplit(";", 1)[-1]] += int(count)
+    return functions.most_common(top), samples.most_common(top)
+
+
+def profile_report(directory, top):
+    """Yield the lines of a per route report of the captures in
+    `directory`."""
+    captures = defaultdict(list)
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith(".json"):
+            with open(os.path.join(directory, filename)) as f:
+                capture = json.load(f)
+            key = (capture["method"], capture["route"] or capture["path"])
+            captures[key].append(capture)
+
+    for (method, route), route_captures in sorted(captures.items()):
+        count = len(route_captures)
+        yield "{} {}: {} captures, {:.1f}ms and {:.1f} SQL statements".format(
+            method,
+            route,
+            count,
+            sum(c["duration"] for c in route_captures) / count * 1000,
+            sum(len(c["statements"]) for c in route_captures) / count,
+        ) + " on average"
+        functions, samples = hot_functions(route_captures, directory, top)
+        for function, seconds in functions:
+            yield "  {:>10.2f}ms  {}".format(seconds * 1000, function)
+        for function, hits in samples:
+            yield "  {:>10} samples  {}".format(hits, function)
+
+
+def register_profiling_commands(app):
+    @app.cli.command("profile-token")
+    def profile_token_command():
+        """Print a signed X-Profile header value to profile a request."""
+        secret = app.config.get("PROFILE_SECRET")
+        if not secret:
+            raise click.UsageError("PROFILE_SECRET is not configured")
+        click.echo(profile_token(secret))
+
+    @app.cli.command("profile-report")
+    @click.option("--dir", "directory", type=click.Path(file_okay=False))
+    @click.option("--top", default=10, help="Functions listed per route.")
+    def profile_report_command(directory, top):
+        """Report the hottest functions per route of the captured
+        profiles."""
+        directory = (
+            directory
+            or app.config.get("PROFILE_DIR")
+            or os.path.join(app.instance_path, "profiles")
+        )
+        if not os.path.isdir(directory):
+            raise click.UsageError("no profiles in {}".format(directory))
+        for line in profile_report(directory, top):
+            click.echo(line)
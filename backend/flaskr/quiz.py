@@ -0,0 +1,351 @@
+import logging
+import random
+import threading
+import time
+
+from flask import current_app
+
+from models import Question, db
+
+from .replicas import read_primary
+from .serialization import question_rows
+
+logger = logging.getLogger(__name__)
+
+
+class QuestionIdIndex:
+    """Question ids per category and difficulty with O(1) inserts and
+    deletes, and expected O(1) draws while most candidates are left.
+
+    Plain data structure without locking or database access, shared by the
+    WSGI and the ASGI app. The key None holds the ids of all questions, a
+    category id those of the category and a `(category, difficulty)` pair
+    those of one difficulty, with category None for all categories.
+    """
+
+    # random picks tried before falling back to filtering the candidates
+    MAX_ATTEMPTS = 16
+
+    def __init__(self, rows=()):
+        self._ids = {None: []}
+        self._positions = {None: {}}
+        self._keys = {}
+        for row in rows:
+            self.add(*row)
+
+    def add(self, question_id, category, difficulty=None):
+        if question_id in self._keys:
+            self.remove(question_id)
+        keys = (None, category)
+        if difficulty is not None:
+            keys += ((None, difficulty), (category, difficulty))
+        self._keys[question_id] = keys
+        for key in keys:
+            ids = self._ids.setdefault(key, [])
+            self._positions.setdefault(key, {})[question_id] = len(ids)
+            ids.append(question_id)
+
+    def remove(self, question_id):
+        for key in self._keys.pop(question_id, ()):
+            ids = self._ids.get(key)
+            positions = self._positions.get(key)
+            if not positions or question_id not in positions:
+                continue
+            # swap the last id into the freed slot to remove in O(1)
+            index = positions.pop(question_id)
+            last_id = ids.pop()
+            if last_id != question_id:
+                ids[index] = last_id
+                positions[last_id] = index
+
+    def sample_id(self, category, excluded):
+        """Return a random id of `category` that is not in `excluded`."""
+        ids = self._ids.get(category, [])
+        positions = self._positions.get(category, {})
+        remaining = len(ids) - sum(1 for i in excluded if i in positions)
+        if remaining <= 0:
+            return None
+        if remaining * 2 >= len(ids):
+            # most candidates are still available, random picks
+            # succeed after two attempts on average
+            for _ in range(self.MAX_ATTEMPTS):
+                question_id = random.choice(ids)
+                if question_id not in excluded:
+                    return question_id
+        return random.choice([i for i in ids if i not in excluded])
+
+    def sample_ids(self, category, excluded, count):
+        """Return up to `count` distinct random ids of `category` that are
+        not in `excluded`."""
+        ids = self._ids.get(category, [])
+        positions = self._positions.get(category, {})
+        remaining = len(ids) - sum(1 for i in excluded if i in positions)
+        count = min(count, remaining)
+        if count <= 0:
+            return []
+        if (remaining - count) * 2 >= len(ids):
+            # most candidates stay available while drawing, random picks
+            # succeed after two attempts on average
+            chosen = []
+            chosen_ids = set()
+            for _ in range(self.MAX_ATTEMPTS * count):
+                question_id = random.choice(ids)
+                if question_id in excluded or question_id in chosen_ids:
+                    continue
+                chosen.append(question_id)
+                chosen_ids.add(question_id)
+                if len(chosen) == count:
+                    return chosen
+        return random.sample([i for i in ids if i not in excluded], count)
+
+    def sample_weighted_id(self, weights, excluded):
+        """Return a random id that is not in `excluded`, from a bucket drawn
+        in proportion to `weights`.
+
+        `weights` maps `(category, difficulty)` bucket keys, with category
+        None for all categories, to weights, so draws can be weighted by
+        category and difficulty at once. The bucket is drawn among those
+        with candidates left, in time linear in the number of buckets. The
+        id is drawn like `sample_id`: in expected O(1) while at least half
+        of the bucket is left, by filtering the bucket otherwise. Returns
+        None once every candidate has been excluded.
+        """
+        weights = {
+            key: weight
+            for key, weight in weights.items()
+            if weight > 0 and self._ids.get(key)
+        }
+        while weights:
+            key = random.choices(
+                list(weights), weights=list(weights.values())
+            )[0]
+            question_id = self.sample_id(key, excluded)
+            if question_id is not None:
+                return question_id
+            del weights[key]
+        return None
+
+    def draw_ids(self, category, count):
+        """Return up to `count` distinct random ids of `category`."""
+        ids = self._ids.get(category, [])
+        return random.sample(ids, min(count, len(ids)))
+
+    def count(self, category):
+        """Number of questions of `category`, all with None."""
+        return len(self._ids.get(category, []))
+
+
+class QuestionSampler:
+    """In-memory `QuestionIdIndex` for drawing quiz questions.
+
+    Draws never load the candidate questions: an id is picked at random from
+    the index and only the chosen question is fetched by primary key. The
+    index is kept current through write listeners and rebuilt from the
+    database every `ttl` seconds to pick up writes made by other processes.
+    Rebuilds of an expired index run in a background thread while draws
+    are served from the old one.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._index = None
+        self._loaded_at = 0.0
+        # writes seen while a new index is built, replayed onto it
+        self._pending = None
+        self._lock = threading.RLock()
+        # held while an index is built, one build at a time
+        self._building = threading.Lock()
+
+    def refresh(self):
+        """Load the id, category and difficulty of every question into the
+        index."""
+        with self._building:
+            self._rebuild()
+
+    def _rebuild(self):
+        with self._lock:
+            self._pending = []
+        try:
+            # from the primary, the index is kept for `ttl` seconds
+            with read_primary():
+                rows = db.session.query(
+                    Question.id, Question.category, Question.difficulty
+                ).all()
+            index = QuestionIdIndex(rows)
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            reload = False
+            for action, question_id, category, difficulty in self._pending:
+                if action == "reload":
+                    reload = True
+                elif action == "delete":
+                    index.remove(question_id)
+                else:
+                    index.add(question_id, category, difficulty)
+            self._pending = None
+            self._index = index
+            # rebuilt again if the database was reloaded during the build
+            self._loaded_at = float("-inf") if reload else time.monotonic()
+
+    def _rebuild_in_background(self, app):
+        if not self._building.acquire(blocking=False):
+            return
+
+        def rebuild():
+            try:
+                with app.app_context():
+                    self._rebuild()
+            except Exception:
+                logger.exception("rebuilding the quiz index failed")
+            finally:
+                self._building.release()
+
+        threading.Thread(target=rebuild, daemon=True).start()
+
+    def on_write(self, action, question):
+        """Write listener keeping the index in sync with `Question` writes."""
+        if question is None:
+            self._write(action, None)
+        else:
+            self._write(
+                action, question.id, question.category, question.difficulty
+            )
+
+    def _write(self, action, question_id, category=None, difficulty=None):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(
+                    (action, question_id, category, difficulty)
+                )
+            if self._index is None:
+                return
+            if action == "reload":
+                # rebuilt on the next draw, served from the old index
+                # meanwhile
+                self._loaded_at = float("-inf")
+            elif action == "delete":
+                self._index.remove(question_id)
+            else:
+                self._index.add(question_id, category, difficulty)
+
+    def sample(self, category, excluded):
+        """Return a random question of `category` whose id is not excluded.
+
+        `category` None draws from all questions. Returns None once every
+        candidate has been excluded.
+        """
+        excluded = set(excluded)
+        while True:
+            index = self._current()
+            with self._lock:
+                question_id = index.sample_id(category, excluded)
+            if question_id is None:
+                return None
+            question = self.get(question_id)
+            if question is not None:
+                return question
+
+    def sample_weighted(self, weights, excluded):
+        """Return a random question whose id is not excluded, from a
+        `(category, difficulty)` bucket drawn in proportion to `weights`.
+
+        Returns None once every candidate has been excluded.
+        """
+        excluded = set(excluded)
+        while True:
+            index = self._current()
+            with self._lock:
+                question_id = index.sample_weighted_id(weights, excluded)
+            if question_id is None:
+                return None
+            question = self.get(question_id)
+            if question is not None:
+                return question
+
+    def count(self, category):
+        """Number of questions of `category`, all with None."""
+        index = self._current()
+        with self._lock:
+            return index.count(category)
+
+    def sample_many(self, category, excluded, count):
+        """Return up to `count` distinct random questions of `category` whose
+        ids are not excluded, as rows of `question_rows`.
+
+        All questions are fetched with a single query unless some of the
+        drawn ones were deleted by another process in the meantime.
+        """
+        excluded = set(excluded)
+        questions = []
+        while len(questions) < count:
+            index = self._current()
+            with self._lock:
+                question_ids = index.sample_ids(
+                    category, excluded, count - len(questions)
+                )
+            if not question_ids:
+                break
+            rows = {
+                row.id: row
+                for row in question_rows(
+                    Question.query.filter(Question.id.in_(question_ids))
+                )
+            }
+            missing = [i for i in question_ids if i not in rows]
+            if missing:
+                rows.update(
+                    (row.id, row)
+                    for row in self._get_rows_from_primary(missing)
+                )
+            questions.extend(rows[i] for i in question_ids if i in rows)
+            excluded.update(question_ids)
+        return questions
+
+    def get(self, question_id):
+        """Return the question `question_id`, None if it was deleted, which
+        also removes it from the index."""
+        question = Question.query.get(question_id)
+        if question is None:
+            # a lagging replica misses new questions, only the primary
+            # tells them apart from deleted ones
+            with read_primary():
+                question = Question.query.get(question_id)
+        if question is None:
+            self._write("delete", question_id)
+        return question
+
+    def _get_rows_from_primary(self, question_ids):
+        """Rows of `question_ids` read from the primary, ids it does not
+        know either were deleted and are removed from the index."""
+        with read_primary():
+            rows = question_rows(
+                Question.query.filter(Question.id.in_(question_ids))
+            ).all()
+        found = {row.id for row in rows}
+        for question_id in question_ids:
+            if question_id not in found:
+                self._write("delete", question_id)
+        return rows
+
+    def draw_ids(self, category, count):
+        """Return up to `count` distinct random question ids of `category`."""
+        index = self._current()
+        with self._lock:
+            return index.draw_ids(category, count)
+
+    def _current(self):
+        """The index to draw from, loaded on first use and rebuilt in the
+        background once expired. Must be called without holding the lock."""
+        with self._lock:
+            index, loaded_at = self._index, self._loaded_at
+        if index is None:
+            # nothing to draw from before the first build
+            self.refresh()
+            with self._lock:
+                return self._index
+        if time.monotonic() - loaded_at >= self.ttl:
+            self._rebuild_in_background(current_app._get_current_object())
+        return index
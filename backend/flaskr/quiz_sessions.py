@@ -0,0 +1,72 @@
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUSessionStore:
+    """Bounded in-memory store for quiz sessions.
+
+    Holds at most `max_sessions` sessions and evicts the least recently used
+    one when full. Sessions idle for longer than `ttl` seconds are dropped on
+    access. Any object with the same `get`, `put` and `delete` methods can be
+    configured as QUIZ_SESSION_STORE instead, e.g. to share sessions between
+    processes. Sessions are plain dicts of json-serializable values.
+    """
+
+    def __init__(self, max_sessions, ttl):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            session, touched_at = entry
+            if time.monotonic() - touched_at >= self.ttl:
+                del self._sessions[session_id]
+                return None
+            self._sessions[session_id] = (session, time.monotonic())
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def put(self, session_id, session):
+        with self._lock:
+            self._sessions[session_id] = (session, time.monotonic())
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+def start_session(store, question_ids):
+    """Store a new session playing `question_ids` in order, return its id."""
+    session_id = secrets.token_urlsafe(16)
+    store.put(session_id, {"question_ids": question_ids, "position": 0})
+    return session_id
+
+
+def next_question_id(store, session_id):
+    """Advance the session and return the id of its next question.
+
+    Returns None once all questions of the session were played. Raises
+    KeyError if the session does not exist or was evicted.
+    """
+    session = store.get(session_id)
+    if session is None:
+        raise KeyError(session_id)
+    position = session["position"]
+    if position >= len(session["question_ids"]):
+        return None
+    session["position"] = position + 1
+    store.put(session_id, session)
+    return session["question_ids"][position]
@@ -0,0 +1,177 @@
+import contextlib
+import functools
+import itertools
+import threading
+import time
+
+from flask import (
+    current_app,
+    g,
+    has_app_context,
+    has_request_context,
+    request,
+)
+from sqlalchemy import create_engine, event
+
+from models import db
+
+STICKY_COOKIE = "trivia_primary_until"
+# kept in the WSGI environ rather than `g`, views write in their own app
+# context
+WROTE_TO_PRIMARY = "trivia.wrote_to_primary"
+
+
+class ReplicaSet:
+    """Engines of the read replicas and which of them are healthy.
+
+    Requests whose views are decorated with `replica_reads` read from the
+    healthy replicas in turn. A replica that fails to connect is skipped for
+    `retry_after` seconds. Clients that wrote to the primary read from it
+    for the next `sticky_seconds` seconds, so they see their own writes
+    before the replicas caught up.
+    """
+
+    def __init__(self, engines, retry_after, sticky_seconds):
+        self.engines = engines
+        self.retry_after = retry_after
+        self.sticky_seconds = sticky_seconds
+        self.reads = 0
+        self.fallbacks = 0
+        self._down_until = {engine: 0.0 for engine in engines}
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    def engine_for_read(self):
+        """The replica the current request reads from, None for the
+        primary."""
+        if not has_app_context() or not g.get("read_from_replica"):
+            return None
+        engine = g.get("replica")
+        if engine is None:
+            now = time.monotonic()
+            with self._lock:
+                healthy = [
+                    engine
+                    for engine in self.engines
+                    if self._down_until[engine] <= now
+                ]
+                if not healthy:
+                    return None
+                engine = healthy[next(self._turn) % len(healthy)]
+                self.reads += 1
+            g.replica = engine
+        return engine
+
+    def record_write(self):
+        if has_request_context():
+            request.environ[WROTE_TO_PRIMARY] = True
+
+    def mark_down(self, engine):
+        with self._lock:
+            self._down_until[engine] = time.monotonic() + self.retry_after
+        if has_app_context() and g.get("replica") is engine:
+            g.replica_failed = True
+
+    def reads_primary(self):
+        """Whether the client wrote recently and should read the primary."""
+        try:
+            return float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+        except ValueError:
+            return False
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "replicas": len(self.engines),
+                "healthy": sum(
+                    1 for until in self._down_until.values() if until <= now
+                ),
+                "reads": self.reads,
+                "fallbacks": self.fallbacks,
+            }
+
+
+def configure_replicas(app):
+    """Route the reads of `replica_reads` views to SQLALCHEMY_REPLICA_URIS.
+
+    Replicas use the engine options of the primary, SQLite ones the
+    defaults. Does nothing when no replica is configured.
+    """
+    uris = app.config.get("SQLALCHEMY_REPLICA_URIS") or []
+    if not uris:
+        return None
+    engines = []
+    for uri in uris:
+        options = {}
+        if not uri.startswith("sqlite"):
+            options = app.config.get("SQLALCHEMY_ENGINE_OPTIONS") or {}
+        engines.append(create_engine(uri, **options))
+    replicas = ReplicaSet(
+        engines,
+        retry_after=app.config.get("REPLICA_RETRY_AFTER", 30),
+        sticky_seconds=app.config.get("REPLICA_STICKY_SECONDS", 5),
+    )
+    app.extensions["read_replicas"] = replicas
+
+    def on_error(context):
+        # failed connects have no connection yet
+        if context.is_disconnect or context.connection is None:
+            replicas.mark_down(context.engine)
+
+    for engine in engines:
+        event.listen(engine, "handle_error", on_error)
+
+    @app.after_request
+    def stick_to_primary(response):
+        if request.environ.get(WROTE_TO_PRIMARY):
+            response.set_cookie(
+                STICKY_COOKIE,
+                str(time.time() + replicas.sticky_seconds),
+                max_age=replicas.sticky_seconds,
+                httponly=True,
+            )
+        return response
+
+    return replicas
+
+
+def replica_reads(view):
+    """Serve the reads of `view` from a read replica when one is configured.
+
+    If the replica fails during the request, the view is run again against
+    the primary.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        replicas = current_app.extensions.get("read_replicas")
+        if replicas is None or replicas.reads_primary():
+            return view(*args, **kwargs)
+        g.read_from_replica = True
+        try:
+            return view(*args, **kwargs)
+        except Exception:
+            if not g.pop("replica_failed", False):
+                raise
+            db.session.rollback()
+            g.read_from_replica = False
+            replicas.fallbacks += 1
+            return view(*args, **kwargs)
+
+    return wrapper
+
+
+@contextlib.contextmanager
+def read_primary():
+    """Send the reads of the block to the primary, for data that must not
+    lag behind, e.g. caches kept for a long time."""
+    if not has_app_context():
+        yield
+        return
+    read_from_replica = g.get("read_from_replica", False)
+    g.read_from_replica = False
+    try:
+        yield
+    finally:
+        g.read_from_replica = read_from_replica
@@ -0,0 +1,145 @@
+import functools
+import threading
+from collections import OrderedDict
+
+from flask import current_app, g, request
+
+from models import table_versions
+
+
+def current_versions(*table_names):
+    """Versions of `table_names`, read at most once per request."""
+    cached_versions = g.setdefault("table_versions", {})
+    missing = [name for name in table_names if name not in cached_versions]
+    if missing:
+        cached_versions.update(zip(missing, table_versions(*missing)))
+    return tuple(cached_versions[name] for name in table_names)
+
+
+class ResponseCache:
+    """In-process LRU cache of serialized response bodies.
+
+    Entries are stored together with the versions of the tables they were
+    built from and are dropped on lookup once a write bumped one of those
+    versions. The cache holds at most `max_bytes` of response bodies and
+    evicts the least recently used entries beyond that.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, versions):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == versions:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._discard(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, versions, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (versions, body)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self.size,
+            }
+
+
+class RedisResponseCache:
+    """Response cache shared by all workers through a Redis-compatible client.
+
+    `client` needs `get(key)` and `set(key, value, ex=seconds)` like
+    redis-py. Table versions are part of the key, so entries built before a
+    write are never read again and expire after `ttl` seconds. Eviction is
+    left to the server's maxmemory policy.
+    """
+
+    def __init__(self, client, ttl, prefix="trivia:response:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, key, versions):
+        return "{}{}:{}".format(self.prefix, versions, key)
+
+    def get(self, key, versions):
+        body = self.client.get(self._key(key, versions))
+        if body is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return body
+
+    def put(self, key, versions, body):
+        self.client.set(self._key(key, versions), body, ex=self.ttl)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def cached_response(*table_names):
+    """Serve the decorated view from the app's response cache.
+
+    The view's response must only depend on the request and the content of
+    `table_names`. Successful json responses are stored as bytes, keyed by
+    view, Accept header, query string, view arguments and request body, so
+    cache hits skip the view, the ORM and json serialization entirely.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            cache = current_app.extensions["response_cache"]
+            key = repr(
+                (
+                    view.__name__,
+                    request.headers.get("Accept"),
+                    request.query_string,
+                    sorted(kwargs.items()),
+                    request.get_data(),
+                )
+            )
+            versions = current_versions(*table_names)
+            body = cache.get(key, versions)
+            if body is not None:
+                return current_app.response_class(
+                    body, mimetype="application/json"
+                )
+            response = current_app.make_response(view(*args, **kwargs))
+            if (
+                response.status_code == 200
+                and response.mimetype == "application/json"
+            ):
+                cache.put(key, versions, response.get_data())
+            return response
+
+        return wrapper
+
+    return decorator
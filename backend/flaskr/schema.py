@@ -0,0 +1,94 @@
+import re
+import sys
+
+import click
+from sqlalchemy import func
+
+from models import Question, bootstrap_db, db
+
+from .search import search_questions
+
+# plan lines of a full scan of the questions table per dialect
+SEQUENTIAL_SCAN_PATTERNS = {
+    "postgresql": re.compile(r"Seq Scan on questions\b"),
+    "sqlite": re.compile(r"^SCAN (TABLE )?questions$"),
+}
+
+
+def hot_queries():
+    """Queries of the request hot paths which must be served by an index."""
+    queries = {
+        "question by id": Question.query.filter(Question.id == 1),
+        "questions after cursor": Question.query.filter(Question.id > 1)
+        .order_by(Question.id)
+        .limit(10),
+        "questions of category": Question.query.filter(Question.category == 1)
+        .order_by(Question.id)
+        .limit(10),
+        "count of category": db.session.query(func.count(Question.id)).filter(
+            Question.category == 1
+        ),
+        "quiz id index": db.session.query(
+            Question.id, Question.category, Question.difficulty
+        ),
+        "questions of difficulty": Question.query.filter(
+            Question.difficulty == 1
+        ),
+    }
+    if db.engine.dialect.name == "postgresql":
+        queries["search"] = search_questions("title").limit(10)
+    return queries
+
+
+def explain(query):
+    """Return the lines of the query plan of `query`."""
+    statement = str(
+        query.statement.compile(
+            dialect=db.engine.dialect, compile_kwargs={"literal_binds": True}
+        )
+    )
+    if db.engine.dialect.name == "sqlite":
+        rows = db.session.execute("EXPLAIN QUERY PLAN " + statement)
+        return [row[-1] for row in rows]
+    return [row[0] for row in db.session.execute("EXPLAIN " + statement)]
+
+
+def find_sequential_scans():
+    """Return the names of the hot queries that scan the whole table.
+
+    Sequential scans are disabled while planning, so a query only shows up
+    here if no index can serve it at all, regardless of the table size.
+    """
+    pattern = SEQUENTIAL_SCAN_PATTERNS.get(db.engine.dialect.name)
+    if pattern is None:
+        raise click.UsageError("check-indexes supports sqlite and postgresql")
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute("SET LOCAL enable_seqscan = off")
+    try:
+        return [
+            name
+            for name, query in hot_queries().items()
+            if any(pattern.search(line) for line in explain(query))
+        ]
+    finally:
+        db.session.rollback()
+
+
+def register_commands(app):
+    @app.cli.command("init-db")
+    def init_db_command():
+        """Create missing tables, indexes and foreign keys."""
+        created = bootstrap_db()
+        for name in created:
+            click.echo("created {}".format(name))
+        click.echo("database is up to date")
+
+    @app.cli.command("check-indexes")
+    def check_indexes_command():
+        """Fail if a hot query cannot be served by an index."""
+        sequential_scans = find_sequential_scans()
+        for name in sequential_scans:
+            click.echo("sequential scan: {}".format(name), err=True)
+        if sequential_scans:
+            sys.exit(1)
+        click.echo("all hot queries are served by indexes")
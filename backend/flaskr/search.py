@@ -0,0 +1,20 @@
+from sqlalchemy import func
+
+from models import Question, db
+
+
+def search_questions(search_term):
+    """Query the questions containing `search_term`, best matches first.
+
+    The case-insensitive substring match is served by the trigram index on
+    `questions.question` on Postgres. Matches are ranked by how well the
+    search term matches a whole word of the question.
+    """
+    query = Question.query.filter(
+        Question.question.ilike("%{}%".format(search_term))
+    )
+    if db.engine.dialect.name == "postgresql":
+        query = query.order_by(
+            func.word_similarity(search_term, Question.question).desc()
+        )
+    return query
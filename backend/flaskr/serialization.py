@@ -0,0 +1,73 @@
+import json
+
+from flask import current_app
+
+from models import Question
+
+try:
+    import orjson
+except ImportError:  # optional, falls back to the standard library
+    orjson = None
+
+QUESTION_FIELDS = ("id", "question", "answer", "category", "difficulty")
+
+
+def question_rows(query):
+    """Select only the serialized columns of the questions of `query`.
+
+    The rows are plain tuples, which skips the identity map and attribute
+    instrumentation the ORM sets up for every hydrated `Question`.
+    """
+    return query.with_entities(
+        *[getattr(Question, field) for field in QUESTION_FIELDS]
+    )
+
+
+def format_rows(rows):
+    """Equivalent of `Question.format` for rows of `question_rows`."""
+    return [dict(zip(QUESTION_FIELDS, row)) for row in rows]
+
+
+def format_stats(categories, counts):
+    """Question counts per category and difficulty of the `/stats` route.
+
+    `categories` maps category ids to their type, `counts` holds
+    (category, difficulty, count) rows. Categories without questions are
+    listed with a total of 0.
+    """
+    stats = {
+        category_id: {
+            "type": category_type,
+            "total_questions": 0,
+            "difficulties": {},
+        }
+        for category_id, category_type in categories.items()
+    }
+    difficulties = {}
+    for category_id, difficulty, count in counts:
+        category = stats.setdefault(
+            category_id,
+            {"type": None, "total_questions": 0, "difficulties": {}},
+        )
+        category["total_questions"] += count
+        category["difficulties"][difficulty] = count
+        difficulties[difficulty] = difficulties.get(difficulty, 0) + count
+    return {
+        "success": True,
+        "total_questions": sum(difficulties.values()),
+        "difficulties": difficulties,
+        "categories": stats,
+    }
+
+
+def dumps(payload):
+    """Serialize `payload` to json bytes, with orjson if it is installed."""
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, separators=(",", ":")).encode()
+
+
+def json_response(payload):
+    return current_app.response_class(
+        dumps(payload), mimetype="application/json"
+    )
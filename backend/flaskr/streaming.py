@@ -0,0 +1,47 @@
+from flask import Response, request, stream_with_context
+
+from models import Question
+
+from .serialization import QUESTION_FIELDS, dumps, question_rows
+
+NDJSON_MIMETYPE = "application/x-ndjson"
+STREAM_BATCH_SIZE = 1000
+
+
+def wants_ndjson():
+    """Whether the request opted into a streamed NDJSON response, either by
+    `?stream=true` or by preferring application/x-ndjson over json."""
+    if request.args.get("stream", "").lower() in ("1", "true"):
+        return True
+    best = request.accept_mimetypes.best_match(
+        ["application/json", NDJSON_MIMETYPE]
+    )
+    return best == NDJSON_MIMETYPE
+
+
+def iter_rows(query, batch_size=STREAM_BATCH_SIZE):
+    """Yield the question columns of every row of `query` as tuples.
+
+    Rows are fetched in batches through a server-side cursor, so memory use
+    does not depend on the number of matching rows. Any ordering of `query`
+    is kept, ties are broken by id.
+    """
+    return (
+        question_rows(query)
+        .order_by(Question.id)
+        .execution_options(stream_results=True)
+        .yield_per(batch_size)
+    )
+
+
+def iter_ndjson(query):
+    """Yield the rows of `query` as lines of NDJSON."""
+    for row in iter_rows(query):
+        yield dumps(dict(zip(QUESTION_FIELDS, row))) + b"\n"
+
+
+def ndjson_response(query):
+    """Stream the questions of `query` as an NDJSON response."""
+    return Response(
+        stream_with_context(iter_ndjson(query)), mimetype=NDJSON_MIMETYPE
+    )
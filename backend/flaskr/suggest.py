@@ -0,0 +1,328 @@
+import bisect
+import itertools
+import logging
+import re
+import threading
+import time
+
+from flask import current_app
+
+from models import Category, Question, db
+
+from .replicas import read_primary
+
+logger = logging.getLogger(__name__)
+
+CATEGORY = "category"
+QUESTION = "question"
+# categories sort before questions sharing a token
+KIND_ORDER = {CATEGORY: 0, QUESTION: 1}
+KINDS = {order: kind for kind, order in KIND_ORDER.items()}
+
+TOKEN = re.compile(r"\w+")
+# keys examined per suggestion, bounds the work of terms matching many
+# entries of which few have the required words
+MAX_EXAMINED = 2000
+
+
+def tokenize(text):
+    """Distinct lower case words of `text`."""
+    return set(TOKEN.findall(text.lower()))
+
+
+class ChunkedKeys:
+    """Sorted keys split into chunks of up to 2 * CHUNK_SIZE keys.
+
+    Inserts and deletes move the keys of one chunk rather than of the whole
+    list, so their cost does not grow with the number of keys. Plain data
+    structure without locking.
+    """
+
+    CHUNK_SIZE = 1000
+
+    def __init__(self, keys=()):
+        keys = sorted(keys)
+        self._chunks = [
+            keys[i : i + self.CHUNK_SIZE]
+            for i in range(0, len(keys), self.CHUNK_SIZE)
+        ]
+        # last key of every chunk, to find the chunk of a key by bisection
+        self._maxes = [chunk[-1] for chunk in self._chunks]
+
+    def _locate(self, key):
+        """Chunk and offset of the first key not less than `key`."""
+        i = bisect.bisect_left(self._maxes, key)
+        if i == len(self._chunks):
+            return i, 0
+        return i, bisect.bisect_left(self._chunks[i], key)
+
+    def insert(self, key):
+        if not self._chunks:
+            self._chunks.append([key])
+            self._maxes.append(key)
+            return
+        i = min(bisect.bisect_left(self._maxes, key), len(self._chunks) - 1)
+        chunk = self._chunks[i]
+        bisect.insort(chunk, key)
+        self._maxes[i] = chunk[-1]
+        if len(chunk) > 2 * self.CHUNK_SIZE:
+            half = chunk[self.CHUNK_SIZE :]
+            del chunk[self.CHUNK_SIZE :]
+            self._chunks.insert(i + 1, half)
+            self._maxes[i] = chunk[-1]
+            self._maxes.insert(i + 1, half[-1])
+
+    def remove(self, key):
+        i, j = self._locate(key)
+        if i == len(self._chunks) or self._chunks[i][j] != key:
+            return
+        chunk = self._chunks[i]
+        del chunk[j]
+        if chunk:
+            self._maxes[i] = chunk[-1]
+        else:
+            del self._chunks[i]
+            del self._maxes[i]
+
+    def irange(self, low, high):
+        """Yield the keys whose word is in [low, high) in order."""
+        end = (high,)
+        i, j = self._locate((low,))
+        while i < len(self._chunks):
+            for key in itertools.islice(self._chunks[i], j, None):
+                if key >= end:
+                    return
+                yield key
+            i, j = i + 1, 0
+
+    def count(self, low, high, cap):
+        """Number of keys whose word is in [low, high), counted up to
+        `cap`."""
+        end = (high,)
+        count = 0
+        i, j = self._locate((low,))
+        while i < len(self._chunks) and count < cap:
+            chunk = self._chunks[i]
+            stop = bisect.bisect_left(chunk, end, j)
+            count += stop - j
+            if stop < len(chunk):
+                break
+            i, j = i + 1, 0
+        return min(count, cap)
+
+
+class PrefixIndex:
+    """Sorted keys of the words of question texts and category names.
+
+    Every word of an entry is kept as a `(word, kind order, id)` key, so the
+    entries with a word starting with a prefix are a contiguous run found by
+    bisection. Plain data structure without locking or database access.
+    """
+
+    def __init__(self, questions=(), categories=()):
+        self._texts = {}
+        keys = []
+        for kind, rows in ((QUESTION, questions), (CATEGORY, categories)):
+            for entry_id, text in rows:
+                self._texts[(kind, entry_id)] = text
+                keys.extend(
+                    (word, KIND_ORDER[kind], entry_id)
+                    for word in tokenize(text)
+                )
+        self._keys = ChunkedKeys(keys)
+
+    def add(self, kind, entry_id, text):
+        self.remove(kind, entry_id)
+        self._texts[(kind, entry_id)] = text
+        for word in tokenize(text):
+            self._keys.insert((word, KIND_ORDER[kind], entry_id))
+
+    def remove(self, kind, entry_id):
+        text = self._texts.pop((kind, entry_id), None)
+        if text is None:
+            return
+        for word in tokenize(text):
+            self._keys.remove((word, KIND_ORDER[kind], entry_id))
+
+    def suggest(self, term, limit):
+        """Return up to `limit` entries matching `term` as dicts.
+
+        The last word of `term` is matched as a prefix, the words before it
+        have to appear in the entry as whole words. Categories come first,
+        then entries in the order of their matched word.
+
+        Walks the shorter of the keys starting with the prefix and the keys
+        of the rarest required word, at most MAX_EXAMINED of them, so terms
+        matching very many entries may miss some.
+        """
+        words = TOKEN.findall(term.lower())
+        if not words:
+            return []
+        prefix, required = words[-1], set(words[:-1])
+        runs = [(word, word + "\0") for word in required]
+        runs.append((prefix, prefix + "\U0010ffff"))
+        counts = [self._keys.count(*run, MAX_EXAMINED + 1) for run in runs]
+        # the prefix run last, so it wins ties
+        rarest = min(range(len(runs)), key=lambda i: (counts[i], -i))
+        if rarest < len(runs) - 1:
+            matches = self._match_word(runs[rarest], prefix, required, limit)
+        else:
+            matches = self._match_prefix(runs[-1], required, limit)
+        return sorted(matches, key=lambda match: match["type"] != CATEGORY)
+
+    def _match_prefix(self, run, required, limit):
+        """Entries of the keys of `run`, which start with the prefix, having
+        all `required` words."""
+        matches = []
+        seen = set()
+        for _, order, entry_id in itertools.islice(
+            self._keys.irange(*run), MAX_EXAMINED
+        ):
+            entry = (KINDS[order], entry_id)
+            if entry in seen:
+                continue
+            seen.add(entry)
+            text = self._texts[entry]
+            if required and not required <= tokenize(text):
+                continue
+            matches.append({"type": entry[0], "id": entry_id, "text": text})
+            if len(matches) == limit:
+                break
+        return matches
+
+    def _match_word(self, run, prefix, required, limit):
+        """Entries of the keys of `run`, which hold a required word, having
+        all `required` words and a word starting with `prefix`."""
+        candidates = []
+        for _, order, entry_id in itertools.islice(
+            self._keys.irange(*run), MAX_EXAMINED
+        ):
+            words = tokenize(self._texts[(KINDS[order], entry_id)])
+            matched = [word for word in words if word.startswith(prefix)]
+            if matched and required <= words:
+                candidates.append((min(matched), order, entry_id))
+        candidates.sort()
+        return [
+            {
+                "type": KINDS[order],
+                "id": entry_id,
+                "text": self._texts[(KINDS[order], entry_id)],
+            }
+            for _, order, entry_id in candidates[:limit]
+        ]
+
+    def __len__(self):
+        return len(self._texts)
+
+
+class Suggestions:
+    """In-memory `PrefixIndex` answering search-as-you-type suggestions
+    without querying the database.
+
+    The index is kept current through write listeners of `Question` and
+    `Category` and rebuilt from the database every `ttl` seconds to pick
+    up writes made by other processes. Rebuilds of an expired index run in
+    a background thread while requests are answered from the old one.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._index = None
+        self._loaded_at = 0.0
+        # writes seen while a new index is built, replayed onto it
+        self._pending = None
+        self._lock = threading.RLock()
+        # held while an index is built, one build at a time
+        self._building = threading.Lock()
+
+    def refresh(self):
+        """Load the texts of all questions and categories into the index."""
+        with self._building:
+            self._rebuild()
+
+    def _rebuild(self):
+        with self._lock:
+            self._pending = []
+        try:
+            # from the primary, the index is kept for `ttl` seconds
+            with read_primary():
+                questions = db.session.query(
+                    Question.id, Question.question
+                ).all()
+                categories = db.session.query(Category.id, Category.type).all()
+            index = PrefixIndex(questions=questions, categories=categories)
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            reload = False
+            latest = {}
+            for action, kind, entry_id, text in self._pending:
+                if action == "reload":
+                    reload = True
+                else:
+                    latest[(kind, entry_id)] = (action, text)
+            for (kind, entry_id), (action, text) in latest.items():
+                if action == "delete":
+                    index.remove(kind, entry_id)
+                else:
+                    index.add(kind, entry_id, text)
+            self._pending = None
+            self._index = index
+            # rebuilt again if the database was reloaded during the build
+            self._loaded_at = float("-inf") if reload else time.monotonic()
+
+    def _rebuild_in_background(self, app):
+        if not self._building.acquire(blocking=False):
+            return
+
+        def rebuild():
+            try:
+                with app.app_context():
+                    self._rebuild()
+            except Exception:
+                logger.exception("rebuilding the suggestion index failed")
+            finally:
+                self._building.release()
+
+        threading.Thread(target=rebuild, daemon=True).start()
+
+    def on_question_write(self, action, question):
+        """Write listener keeping the index in sync with `Question` writes."""
+        self._on_write(action, QUESTION, question, "question")
+
+    def on_category_write(self, action, category):
+        """Write listener keeping the index in sync with `Category` writes."""
+        self._on_write(action, CATEGORY, category, "type")
+
+    def _on_write(self, action, kind, instance, text_attribute):
+        if instance is None:
+            entry_id = text = None
+        else:
+            entry_id = instance.id
+            text = getattr(instance, text_attribute)
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((action, kind, entry_id, text))
+            if self._index is None:
+                return
+            if action == "reload":
+                # rebuilt on the next suggestion, answered from the old
+                # index meanwhile
+                self._loaded_at = float("-inf")
+            elif action == "delete":
+                self._index.remove(kind, entry_id)
+            else:
+                self._index.add(kind, entry_id, text)
+
+    def suggest(self, term, limit):
+        with self._lock:
+            index, loaded_at = self._index, self._loaded_at
+        if index is None:
+            # nothing to answer from before the first build
+            self.refresh()
+        elif time.monotonic() - loaded_at >= self.ttl:
+            self._rebuild_in_background(current_app._get_current_object())
+        with self._lock:
+            return (index or self._index).suggest(term, limit)
@@ -1,6 +1,21 @@
 import os
-from sqlalchemy import Column, String, Integer
-from flask_sqlalchemy import SQLAlchemy
+from flask import current_app
+from sqlalchemy import (
+    DDL,
+    Column,
+    ForeignKey,
+    Index,
+    String,
+    Integer,
+    event,
+    func,
+    inspect,
+    orm,
+    select,
+)
+from sqlalchemy.schema import AddConstraint
+from sqlalchemy.sql.expression import UpdateBase
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
 
 database_name = "trivia"
 database_path = "postgresql://{}:{}{}/{}".format(
@@ -10,20 +25,151 @@ database_path = "postgresql://{}:{}{}/{}".format(
     database_name,
 )
 
-db = SQLAlchemy()
+
+"""
+RoutingSession
+    sends the reads of a request to a read replica when the app's
+    "read_replicas" extension picks one for it, flushes and bulk updates or
+    deletes always go to the primary
+"""
+
+
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        replicas = self.app.extensions.get("read_replicas")
+        if replicas is not None:
+            if self._flushing or isinstance(clause, UpdateBase):
+                replicas.record_write()
+            else:
+                engine = replicas.engine_for_read()
+                if engine is not None:
+                    return engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy()
 
 """
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service, creates missing
+    tables unless DB_CREATE_ALL is off, then opens DB_POOL_PREWARM
+    connections so the first requests do not pay for them
 """
 
+# databases whose tables were created by this process, checked only once
+_created_databases = set()
+
 
 def setup_db(
     app,
 ):
     db.app = app
     db.init_app(app)
+    if app.config.get("DB_CREATE_ALL", True):
+        create_tables_once()
+    warm_pool(app.config.get("DB_POOL_PREWARM", 0))
+
+
+def create_tables_once():
+    url = db.engine.url
+    # every in-memory sqlite engine has a database of its own
+    in_memory = url.drivername.startswith("sqlite") and url.database in (
+        None,
+        "",
+        ":memory:",
+    )
+    if in_memory or str(url) not in _created_databases:
+        db.create_all()
+        if not in_memory:
+            _created_databases.add(str(url))
+
+
+def warm_pool(size):
+    connections = [db.engine.connect() for _ in range(size)]
+    for connection in connections:
+        connection.close()
+
+
+"""
+bootstrap_db()
+    brings an existing database up to date with the models: creates missing
+    tables, indexes and foreign keys and recounts the questions per
+    category, returns the names of what was created
+"""
+
+
+def bootstrap_db():
+    created = []
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        db.session.commit()
+    inspector = inspect(db.engine)
+    table_names = inspector.get_table_names()
+    missing_tables = [
+        table
+        for table in db.metadata.sorted_tables
+        if table.name not in table_names
+    ]
     db.create_all()
+    created.extend(table.name for table in missing_tables)
+
+    for table in db.metadata.sorted_tables:
+        if table in missing_tables:
+            continue
+        existing_indexes = {
+            index["name"] for index in inspector.get_indexes(table.name)
+        }
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(bind=db.engine)
+                created.append(index.name)
+
+        if db.engine.dialect.name == "sqlite":
+            # sqlite cannot add constraints to an existing table
+            continue
+        existing_foreign_keys = [
+            foreign_key["constrained_columns"]
+            for foreign_key in inspector.get_foreign_keys(table.name)
+        ]
+        for foreign_key in table.foreign_key_constraints:
+            if foreign_key.column_keys not in existing_foreign_keys:
+                db.session.execute(AddConstraint(foreign_key))
+                db.session.commit()
+                created.append(foreign_key.name)
+
+    refresh_question_counts()
+    db.session.commit()
+    return created
+
+
+"""
+listen_for_writes(app, model, listener)
+    registers listener(action, instance) to be called by the app whenever an
+    instance of model was inserted, updated or deleted through its methods,
+    or with ("reload", None) after rows were written in bulk
+"""
+
+
+def listen_for_writes(app, model, listener):
+    listeners = app.extensions.setdefault("trivia_write_listeners", {})
+    listeners.setdefault(model.__tablename__, []).append(listener)
+
+
+def notify_write(action, instance):
+    listeners = current_app.extensions.get("trivia_write_listeners", {})
+    for listener in listeners.get(instance.__tablename__, []):
+        listener(action, instance)
+
+
+def notify_reload(model):
+    listeners = current_app.extensions.get("trivia_write_listeners", {})
+    for listener in listeners.get(model.__tablename__, []):
+        listener("reload", None)
 
 
 """
@@ -38,9 +184,32 @@ class Question(db.Model):
     id = Column(Integer, primary_key=True)
     question = Column(String, nullable=False)
     answer = Column(String, nullable=False)
-    category = Column(Integer, nullable=False)
+    category = Column(
+        Integer,
+        ForeignKey("categories.id", name="questions_category_fkey"),
+        nullable=False,
+    )
     difficulty = Column(Integer, nullable=False)
 
+    __table_args__ = (
+        # per category listings, category counts and the quiz id index,
+        # which also reads the difficulty
+        Index(
+            "ix_questions_category_id_difficulty",
+            "category",
+            "id",
+            "difficulty",
+        ),
+        Index("ix_questions_difficulty", "difficulty"),
+        # serves the case-insensitive substring search on Postgres
+        Index(
+            "ix_questions_question_trgm",
+            "question",
+            postgresql_using="gin",
+            postgresql_ops={"question": "gin_trgm_ops"},
+        ),
+    )
+
     def __init__(self, question, answer, category, difficulty):
         self.question = question
         self.answer = answer
@@ -49,14 +218,33 @@ class Question(db.Model):
 
     def insert(self):
         db.session.add(self)
+        bump_version(self.__tablename__)
+        change_question_count(self.category, self.difficulty, 1)
         db.session.commit()
+        notify_write("insert", self)
 
     def update(self):
+        # read before bump_version autoflushes and resets the history
+        attrs = inspect(self).attrs
+        previous_categories = attrs.category.history.deleted
+        previous_difficulties = attrs.difficulty.history.deleted
+        bump_version(self.__tablename__)
+        if previous_categories or previous_difficulties:
+            change_question_count(
+                (previous_categories or [self.category])[0],
+                (previous_difficulties or [self.difficulty])[0],
+                -1,
+            )
+            change_question_count(self.category, self.difficulty, 1)
         db.session.commit()
+        notify_write("update", self)
 
     def delete(self):
         db.session.delete(self)
+        bump_version(self.__tablename__)
+        change_question_count(self.category, self.difficulty, -1)
         db.session.commit()
+        notify_write("delete", self)
 
     def format(self):
         return {
@@ -68,6 +256,15 @@ class Question(db.Model):
         }
 
 
+event.listen(
+    Question.__table__,
+    "before_create",
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(
+        dialect="postgresql"
+    ),
+)
+
+
 """
 Category
 
@@ -83,5 +280,158 @@ class Category(db.Model):
     def __init__(self, type):
         self.type = type
 
+    def insert(self):
+        db.session.add(self)
+        bump_version(self.__tablename__)
+        db.session.commit()
+        notify_write("insert", self)
+
+    def update(self):
+        bump_version(self.__tablename__)
+        db.session.commit()
+        notify_write("update", self)
+
+    def delete(self):
+        db.session.delete(self)
+        bump_version(self.__tablename__)
+        db.session.commit()
+        notify_write("delete", self)
+
     def format(self):
         return {"id": self.id, "type": self.type}
+
+
+"""
+TableVersion
+    a counter per table, bumped in the same transaction as every write made
+    through the model methods, shared by all processes using the database
+"""
+
+
+class TableVersion(db.Model):
+    __tablename__ = "table_versions"
+
+    table_name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+    def __init__(self, table_name, version=0):
+        self.table_name = table_name
+        self.version = version
+
+
+@event.listens_for(TableVersion.__table__, "after_create")
+def create_table_versions(target, connection, **kw):
+    connection.execute(
+        target.insert(),
+        [
+            {"table_name": table_name, "version": 0}
+            for table_name in (Question.__tablename__, Category.__tablename__)
+        ],
+    )
+
+
+def bump_version(table_name):
+    updated = TableVersion.query.filter_by(table_name=table_name).update(
+        {TableVersion.version: TableVersion.version + 1},
+        synchronize_session=False,
+    )
+    if not updated:
+        db.session.add(TableVersion(table_name, version=1))
+
+
+def table_versions(*table_names):
+    versions = dict(
+        db.session.query(TableVersion.table_name, TableVersion.version)
+        .filter(TableVersion.table_name.in_(table_names))
+        .all()
+    )
+    return tuple(versions.get(table_name, 0) for table_name in table_names)
+
+
+"""
+DifficultyCount
+    the number of questions per category and difficulty, maintained in the
+    same transaction as every write made through the Question methods, so
+    totals and statistics never require counting the questions table
+"""
+
+
+class DifficultyCount(db.Model):
+    __tablename__ = "question_difficulty_counts"
+
+    category = Column(Integer, primary_key=True)
+    difficulty = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False)
+
+    def __init__(self, category, difficulty, count=0):
+        self.category = category
+        self.difficulty = difficulty
+        self.count = count
+
+
+@event.listens_for(db.Model.metadata, "after_create")
+def create_question_counts(target, connection, tables=(), **kw):
+    if DifficultyCount.__table__ in tables:
+        refresh_question_counts(connection)
+
+
+def refresh_question_counts(connection=None):
+    connection = connection or db.session.connection()
+    counts = DifficultyCount.__table__
+    connection.execute(counts.delete())
+    connection.execute(
+        counts.insert().from_select(
+            [counts.c.category, counts.c.difficulty, counts.c.count],
+            select(
+                [
+                    Question.category,
+                    Question.difficulty,
+                    func.count(Question.id),
+                ]
+            ).group_by(Question.category, Question.difficulty),
+        )
+    )
+
+
+def change_question_count(category, difficulty, delta):
+    if delta > 0:
+        # an upsert, concurrent first writes of a category and difficulty
+        # cannot both insert its row
+        db.session.execute(
+            "INSERT INTO question_difficulty_counts "
+            "(category, difficulty, count) "
+            "VALUES (:category, :difficulty, :delta) "
+            "ON CONFLICT (category, difficulty) "
+            "DO UPDATE SET count = question_difficulty_counts.count + :delta",
+            {"category": category, "difficulty": difficulty, "delta": delta},
+        )
+    else:
+        # questions being removed were counted, never insert a negative row
+        DifficultyCount.query.filter_by(
+            category=category, difficulty=difficulty
+        ).update(
+            {DifficultyCount.count: DifficultyCount.count + delta},
+            synchronize_session=False,
+        )
+
+
+def question_count(category=None):
+    """Number of questions of `category`, of all categories with None, summed
+    over the difficulty counts."""
+    query = db.session.query(func.coalesce(func.sum(DifficultyCount.count), 0))
+    if category is not None:
+        query = query.filter(DifficultyCount.category == category)
+    return query.scalar()
+
+
+def difficulty_counts():
+    return (
+        db.session.query(
+            DifficultyCount.category,
+            DifficultyCount.difficulty,
+            DifficultyCount.count,
+        )
+        .filter(DifficultyCount.count > 0)
+        .order_by(DifficultyCount.category, DifficultyCount.difficulty)
+        .all()
+    )
@@ -1,8 +1,26 @@
+import asyncio
+import json
+import os
+import tempfile
 import unittest
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine
 
-from flaskr import create_app
-from models import setup_db, Question
+from flaskr import asgi, create_app
+from flaskr.adaptive import bucket_weights
+from flaskr.pool import TimedQueuePool, pool_stats
+from flaskr.quiz import QuestionIdIndex
+from flaskr.suggest import ChunkedKeys, PrefixIndex
+from flaskr.profiling import profile_report, profile_token
+from flaskr.schema import find_sequential_scans
+from models import (
+    bootstrap_db,
+    change_question_count,
+    difficulty_counts,
+    question_count,
+    db,
+    Category,
+    Question,
+)
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -15,16 +33,10 @@ class TriviaTestCase(unittest.TestCase):
             "SQLALCHEMY_TRACK_MODIFICATIONS": False,
             "TESTING": True,
         }
+        # create_app binds the models' db and creates missing tables
         self.app = create_app(test_config)
-        setup_db(self.app)
         self.client = self.app.test_client
-
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
+        self.db = db
 
     def tearDown(self):
         """Executed after reach test"""
@@ -43,6 +55,60 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(res.json["categories"])
         self.assertTrue(res.json["total_categories"])
 
+    def test_get_categories_should_be_served_from_cache(self):
+        """Repeated category lookups should not reload the categories."""
+        cache = self.app.extensions["category_cache"]
+        misses = cache.stats()["misses"]
+
+        self.client().get("/categories")
+        res = self.client().get("/questions")
+
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(misses, cache.stats()["misses"])
+        self.assertGreaterEqual(cache.stats()["hits"], 2)
+
+    def test_category_cache_should_be_invalidated_on_write(self):
+        """Adding a category through the model should show up right away."""
+        self.client().get("/categories")
+        with self.app.app_context():
+            category = Category(type="Music")
+            category.insert()
+            try:
+                res = self.client().get("/categories")
+                self.assertEqual(
+                    "Music", res.json["categories"][str(category.id)]
+                )
+            finally:
+                category.delete()
+
+    def test_category_cache_should_follow_writes_of_other_workers(self):
+        """A category added by another process should be served as soon as
+        the categories table version moved, not once the cache expired."""
+        other = create_app(
+            {
+                "SQLALCHEMY_DATABASE_URI": self.app.config[
+                    "SQLALCHEMY_DATABASE_URI"
+                ],
+                "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+                "TESTING": True,
+            }
+        )
+        self.client().get("/categories")
+        with other.app_context():
+            category = Category(type="Opera")
+            category.insert()
+            category_id = category.id
+
+        def delete():
+            with other.app_context():
+                Category.query.get(category_id).delete()
+
+        self.addCleanup(delete)
+
+        res = self.client().get("/categories")
+
+        self.assertEqual("Opera", res.json["categories"][str(category_id)])
+
     def test_get_questions_should_return_results(self):
         """Test get request to '/questions' route returns results in expected format"""
         res = self.client().get("/questions?page=2")
@@ -59,6 +125,79 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(res.json["total_questions"])
         self.assertTrue(res.json["current_category"])
 
+    def test_get_questions_total_should_count_all_questions(self):
+        """total_questions is the table count, not the size of the page."""
+        res = self.client().get("/questions")
+
+        self.assertEqual(200, res.status_code)
+        self.assertLessEqual(len(res.json["questions"]), 10)
+        with self.app.app_context():
+            self.assertEqual(
+                Question.query.count(), res.json["total_questions"]
+            )
+
+    def test_get_questions_should_answer_conditional_request_with_304(self):
+        """A request with the current ETag should not return a body."""
+        res = self.client().get("/questions")
+        self.assertEqual(200, res.status_code)
+        self.assertTrue(res.headers["ETag"])
+        self.assertIn("Cache-Control", res.headers)
+
+        res = self.client().get(
+            "/questions", headers={"If-None-Match": res.headers["ETag"]}
+        )
+
+        self.assertEqual(304, res.status_code)
+        self.assertFalse(res.data)
+
+    def test_get_questions_etag_should_change_after_write(self):
+        """Adding a question should invalidate the ETag of the listing."""
+        etag = self.client().get("/questions").headers["ETag"]
+        created = self.client().post(
+            "/questions",
+            json={
+                "question": "Who painted the Mona Lisa?",
+                "answer": "Leonardo da Vinci",
+                "category": 2,
+                "difficulty": 1,
+            },
+        )
+        self.addCleanup(
+            self.client().delete,
+            "/questions/{}".format(created.json["created"]),
+        )
+
+        res = self.client().get("/questions", headers={"If-None-Match": etag})
+
+        self.assertEqual(200, res.status_code)
+        self.assertNotEqual(etag, res.headers["ETag"])
+
+    def test_get_questions_should_stream_ndjson_when_accepted(self):
+        """Accepting NDJSON should stream every question, one per line."""
+        res = self.client().get(
+            "/questions", headers={"Accept": "application/x-ndjson"}
+        )
+
+        self.assertEqual(200, res.status_code)
+        self.assertEqual("application/x-ndjson", res.mimetype)
+        questions = [json.loads(line) for line in res.data.splitlines()]
+        with self.app.app_context():
+            self.assertEqual(Question.query.count(), len(questions))
+        self.assertEqual(
+            {"id", "question", "answer", "category", "difficulty"},
+            set(questions[0]),
+        )
+
+    def test_get_questions_of_category_should_stream_with_query_flag(self):
+        """?stream=true should stream only the questions of the category."""
+        res = self.client().get("/categories/1/questions?stream=true")
+
+        self.assertEqual(200, res.status_code)
+        categories = {
+            json.loads(line)["category"] for line in res.data.splitlines()
+        }
+        self.assertEqual({1}, categories)
+
     def test_get_questions_should_raise_404(self):
         """If pagination exceeds number of available pages, return 404."""
         res = self.client().get("/questions?page=1000")
@@ -67,6 +206,31 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue("success" in res.json and "error" in res.json)
         self.assertFalse(res.json["success"])
 
+    def test_get_questions_cursor_mode_should_walk_all_questions(self):
+        """Following next_cursor should visit every question exactly once."""
+        seen_ids = []
+        res = self.client().get("/questions?limit=5")
+        while True:
+            self.assertEqual(200, res.status_code)
+            self.assertLessEqual(len(res.json["questions"]), 5)
+            seen_ids.extend(q["id"] for q in res.json["questions"])
+            if not res.json["next_cursor"]:
+                break
+            res = self.client().get(
+                "/questions?limit=5&after={}".format(res.json["next_cursor"])
+            )
+
+        with self.app.app_context():
+            all_ids = [q.id for q in Question.query.order_by(Question.id)]
+        self.assertEqual(all_ids, seen_ids)
+
+    def test_get_questions_invalid_cursor_should_return_422(self):
+        """A cursor that was not issued by the api should raise a 422 error."""
+        res = self.client().get("/questions?after=not-a-cursor")
+
+        self.assertEqual(422, res.status_code)
+        self.assertFalse(res.json["success"])
+
     def test_delete_question_should_remove_db_entry(self):
         """Making a delete request should remove question from db"""
         # check question is in db before request
@@ -90,6 +254,84 @@ class TriviaTestCase(unittest.TestCase):
             question = Question.query.get(question_id)
             self.assertIsNone(question)
 
+    def test_delete_question_minimal_should_not_list_questions(self):
+        """With Prefer: return=minimal only the deleted id is returned."""
+        with self.app.app_context():
+            question = Question("Minimal?", "Yes", 1, 1)
+            question.insert()
+            question_id = question.id
+
+        res = self.client().delete(
+            f"/questions/{question_id}",
+            headers={"Prefer": "return=minimal"},
+        )
+
+        self.assertEqual(200, res.status_code)
+        self.assertEqual({"success": True, "deleted": question_id}, res.json)
+        self.assertEqual("return=minimal", res.headers["Preference-Applied"])
+
+    def test_question_counts_should_follow_writes(self):
+        """Maintained counts should match the questions table after writes."""
+        res = self.client().post(
+            "/questions",
+            json={
+                "question": "What is the boiling point of water in Kelvin?",
+                "answer": "373",
+                "category": 1,
+                "difficulty": 2,
+            },
+        )
+        self.client().delete(f"/questions/{res.json['created']}")
+        created = self.client().post(
+            "/questions",
+            json={
+                "question": "Which planet is known as the Red Planet?",
+                "answer": "Mars",
+                "category": 1,
+                "difficulty": 1,
+            },
+        )
+        self.addCleanup(
+            self.client().delete,
+            "/questions/{}".format(created.json["created"]),
+        )
+
+        with self.app.app_context():
+            self.assertEqual(Question.query.count(), question_count())
+            self.assertEqual(
+                Question.query.filter(Question.category == 1).count(),
+                question_count(1),
+            )
+
+    def test_question_counts_should_follow_category_moves(self):
+        """Moving a question should update the counts of both categories."""
+        with self.app.app_context():
+            question = Question("Which category am I in?", "Both", 1, 1)
+            question.insert()
+            question_id = question.id
+            before = question_count(1), question_count(2)
+            question.category = 2
+            question.update()
+            after = question_count(1), question_count(2)
+            question.delete()
+
+        self.assertEqual((before[0] - 1, before[1] + 1), after)
+        with self.app.app_context():
+            self.assertIsNone(Question.query.get(question_id))
+            self.assertEqual(
+                Question.query.filter(Question.category == 2).count(),
+                question_count(2),
+            )
+
+    def test_question_counts_should_not_go_negative(self):
+        """Removing a question that was never counted should not create a
+        negative count."""
+        with self.app.app_context():
+            change_question_count(1000, 1, -1)
+            self.assertEqual(0, question_count(1000))
+            self.assertNotIn(1000, [row[0] for row in difficulty_counts()])
+            db.session.rollback()
+
     def test_delete_question_should_raise_404(self):
         """Trying to delete a question that does not exist should raise a 404 error."""
         # make DELETE request
@@ -140,6 +382,408 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue("success" in res.json and "error" in res.json)
         self.assertFalse(res.json["success"])
 
+    def test_post_new_question_unknown_category_should_return_422(self):
+        """A question can only be added to an existing category."""
+        res = self.client().post(
+            "/questions",
+            json={
+                "question": "Who was the second James Bond Actor?",
+                "answer": "Roger Moore",
+                "category": 10000,
+                "difficulty": 3,
+            },
+        )
+
+        self.assertEqual(422, res.status_code)
+        self.assertFalse(res.json["success"])
+
+    def test_hot_queries_should_be_served_by_indexes(self):
+        """Listing, counting and quiz queries must not scan the table."""
+        with self.app.app_context():
+            bootstrap_db()
+            self.assertEqual([], find_sequential_scans())
+
+    def test_lazy_startup_should_leave_schema_to_init_db(self):
+        """Without DB_CREATE_ALL the app boots without touching the schema
+        and serves requests once the tables were bootstrapped."""
+        database_url = "sqlite:///{}".format(
+            os.path.join(tempfile.mkdtemp(), "trivia.db")
+        )
+        app = create_app(
+            {
+                "SQLALCHEMY_DATABASE_URI": database_url,
+                "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+                "DB_CREATE_ALL": False,
+                "PRELOAD_INDEXES": False,
+                "TESTING": True,
+            }
+        )
+        with app.app_context():
+            self.assertEqual([], db.engine.table_names())
+            bootstrap_db()
+            db.session.add(Category(type="Science"))
+            db.session.commit()
+
+        res = app.test_client().get("/categories")
+
+        self.assertEqual(200, res.status_code)
+        self.assertEqual({"1": "Science"}, res.json["categories"])
+
+    def test_timed_pool_should_record_checkout_waits(self):
+        """Every connection checkout should be recorded in the histogram."""
+        engine = create_engine(
+            "sqlite://", poolclass=TimedQueuePool, pool_size=1
+        )
+        engine.connect().close()
+        engine.connect().close()
+
+        stats = pool_stats(engine)
+        self.assertEqual(2, stats["checkout_wait"]["count"])
+        self.assertEqual(0, stats["checked_out"])
+
+    def test_metrics_should_report_requests_per_route(self):
+        """/metrics should count requests, statements and bytes per
+        route."""
+        self.client().get("/questions?page=2").get_data()
+
+        res = self.client().get("/metrics")
+
+        self.assertEqual(200, res.status_code)
+        self.assertEqual("text/plain", res.mimetype)
+        metrics = res.get_data(as_text=True)
+        labels = '{route="/questions",method="GET"}'
+        for name in (
+            "trivia_request_duration_seconds",
+            "trivia_request_sql_statements",
+            "trivia_request_db_seconds",
+            "trivia_response_size_bytes",
+        ):
+            self.assertIn("{}_count{} 1".format(name, labels), metrics)
+        self.assertIn(
+            'trivia_responses_total{route="/questions",method="GET",'
+            'status="200"} 1',
+            metrics,
+        )
+
+    def test_slow_request_should_be_logged_with_its_sql(self):
+        """Requests over SLOW_REQUEST_SECONDS should log their
+        statements."""
+        app = create_app(
+            {
+                "SQLALCHEMY_DATABASE_URI": self.app.config[
+                    "SQLALCHEMY_DATABASE_URI"
+                ],
+                "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+                "SLOW_REQUEST_SECONDS": 0,
+                "TESTING": True,
+            }
+        )
+
+        with self.assertLogs(app.logger, "WARNING") as logs:
+            app.test_client().get("/questions?page=2").get_data()
+
+        self.assertIn("slow request GET /questions", logs.output[0])
+        self.assertIn("FROM questions", logs.output[0])
+
+    def create_profiling_app(self, **config):
+        return create_app(
+            {
+                "SQLALCHEMY_DATABASE_URI": self.app.config[
+                    "SQLALCHEMY_DATABASE_URI"
+                ],
+                "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+                "PROFILE_DIR": tempfile.mkdtemp(),
+                "TESTING": True,
+                **config,
+            }
+        )
+
+    def test_signed_profile_header_should_capture_profile_and_sql(self):
+        """A request with a valid X-Profile token should be profiled."""
+        app = self.create_profiling_app(PROFILE_SECRET="secret")
+        directory = app.config["PROFILE_DIR"]
+
+        app.test_client().get(
+            "/questions", headers={"X-Profile": profile_token("secret")}
+        ).get_data()
+        app.test_client().get(
+            "/questions", headers={"X-Profile": profile_token("other")}
+        ).get_data()
+
+        captures = [f for f in os.listdir(directory) if f.endswith(".json")]
+        self.assertEqual(1, len(captures))
+        with open(os.path.join(directory, captures[0])) as f:
+            capture = json.load(f)
+        self.assertEqual("/questions", capture["route"])
+        self.assertTrue(capture["statements"])
+        self.assertTrue(
+            os.path.exists(os.path.join(directory, capture["profile"]))
+        )
+        report = list(profile_report(directory, top=5))
+        self.assertTrue(report[0].startswith("GET /questions: 1 captures"))
+        self.assertEqual(6, len(report))
+
+    def test_sampling_profiler_should_write_collapsed_stacks(self):
+        """Sampled requests should be captured as collapsed stacks."""
+        app = self.create_profiling_app(
+            PROFILE_SAMPLE_RATE=1.0,
+            PROFILER="sampling",
+            PROFILE_SAMPLE_INTERVAL=0.0001,
+        )
+
+        app.test_client().get("/questions").get_data()
+
+        directory = app.config["PROFILE_DIR"]
+        stacks = [f for f in os.listdir(directory) if f.endswith(".collapsed")]
+        self.assertEqual(1, len(stacks))
+
+    def create_replica_app(self, *replica_uris):
+        return create_app(
+            {
+                "SQLALCHEMY_DATABASE_URI": self.app.config[
+                    "SQLALCHEMY_DATABASE_URI"
+                ],
+                "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+                "SQLALCHEMY_REPLICA_URIS": list(replica_uris),
+                "TESTING": True,
+            }
+        )
+
+    def test_reads_should_be_routed_to_replica(self):
+        """Listings should be read from a configured replica."""
+        app = self.create_replica_app(
+            self.app.config["SQLALCHEMY_DATABASE_URI"]
+        )
+        replicas = app.extensions["read_replicas"]
+
+        res = app.test_client().get("/questions")
+
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(1, replicas.stats()["reads"])
+
+    def test_reads_after_write_should_stick_to_primary(self):
+        """A client that just wrote should read its write from the
+        primary."""
+        app = self.create_replica_app(
+            self.app.config["SQLALCHEMY_DATABASE_URI"]
+        )
+        replicas = app.extensions["read_replicas"]
+        client = app.test_client()
+
+        res = client.post(
+            "/questions",
+            json={
+                "question": "Which planet is known as the red planet?",
+                "answer": "Mars",
+                "category": 1,
+                "difficulty": 1,
+            },
+            headers={"Prefer": "return=minimal"},
+        )
+        try:
+            self.assertIn("trivia_primary_until", res.headers["Set-Cookie"])
+            read = client.get("/categories/1/questions")
+
+            self.assertEqual(200, read.status_code)
+            self.assertEqual(0, replicas.stats()["reads"])
+        finally:
+            client.delete("/questions/{}".format(res.json["created"]))
+
+    def test_unreachable_replica_should_fall_back_to_primary(self):
+        """Reads should be answered by the primary while a replica is
+        down."""
+        app = self.create_replica_app("sqlite:////nonexistent/replica.db")
+        replicas = app.extensions["read_replicas"]
+
+        res = app.test_client().get("/categories")
+
+        self.assertEqual(200, res.status_code)
+        self.assertTrue(res.json["categories"])
+        self.assertEqual(0, replicas.stats()["healthy"])
+        self.assertEqual(1, replicas.stats()["fallbacks"])
+
+    def test_lagging_replica_should_not_drop_quiz_questions(self):
+        """Questions missing on a replica should be read from the primary
+        and kept in the quiz index."""
+        replica_uri = "sqlite:///{}".format(
+            os.path.join(tempfile.mkdtemp(), "replica.db")
+        )
+        # an empty replica, as if it had not caught up yet
+        db.metadata.create_all(create_engine(replica_uri))
+        app = self.create_replica_app(replica_uri)
+        sampler = app.extensions["question_sampler"]
+        with app.app_context():
+            total = sampler.count(None)
+
+        client = app.test_client()
+        one = client.post("/quizzes", json={"previous_questions": []})
+        many = client.post(
+            "/quizzes", json={"previous_questions": [], "count": 3}
+        )
+        session = client.post("/quizzes/sessions", json={"length": 3})
+        url = "/quizzes/sessions/{}/next".format(session.json["session_id"])
+        played = [client.post(url).json.get("question") for _ in range(3)]
+
+        self.assertEqual(200, one.status_code)
+        self.assertTrue(one.json["question"])
+        self.assertEqual(3, len(many.json["questions"]))
+        self.assertTrue(all(played))
+        with app.app_context():
+            self.assertEqual(total, sampler.count(None))
+
+    def test_expired_quiz_index_should_rebuild_in_background(self):
+        """Draws should be served from an expired index while it is
+        rebuilt."""
+        app = create_app(
+            {
+                "SQLALCHEMY_DATABASE_URI": self.app.config[
+                    "SQLALCHEMY_DATABASE_URI"
+                ],
+                "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+                "QUIZ_INDEX_TTL": 0,
+                "TESTING": True,
+            }
+        )
+        sampler = app.extensions["question_sampler"]
+        with app.app_context():
+            # behind the back of the write listeners, like another process
+            question_id = db.session.execute(
+                "INSERT INTO questions (question, answer, category, "
+                "difficulty) VALUES ('Rebuilt?', 'Yes', 1, 1) RETURNING id"
+            ).scalar()
+            db.session.commit()
+
+        def delete():
+            with app.app_context():
+                db.session.execute(
+                    "DELETE FROM questions WHERE id = :id", {"id": question_id}
+                )
+                db.session.commit()
+
+        self.addCleanup(delete)
+
+        with app.app_context():
+            stale = sampler.count(1)
+        # wait for the rebuild started by the draw
+        with sampler._building:
+            pass
+        with app.app_context():
+            fresh = sampler.count(1)
+
+        self.assertEqual(stale + 1, fresh)
+
+    def test_import_questions_should_load_valid_rows(self):
+        """Valid NDJSON rows should be imported, invalid ones reported."""
+        with self.app.app_context():
+            total_before = Question.query.count()
+        lines = [
+            '{"question": "Q1?", "answer": "A1", "category": 1, '
+            '"difficulty": 1}',
+            '{"question": "Q2?", "answer": "A2", "category": 10000, '
+            '"difficulty": 1}',
+            "not json",
+            '{"question": "Q3?", "answer": "A3", "category": "2", '
+            '"difficulty": 3}',
+        ]
+
+        def delete_imported():
+            with self.app.app_context():
+                for question in Question.query.filter(
+                    Question.question.in_(["Q1?", "Q3?"])
+                ):
+                    question.delete()
+
+        res = self.client().post(
+            "/questions/import",
+            data="\n".join(lines),
+            content_type="application/x-ndjson",
+        )
+        self.addCleanup(delete_imported)
+
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(2, res.json["imported"])
+        self.assertEqual(2, res.json["rejected"])
+        self.assertEqual([2, 3], [e["line"] for e in res.json["errors"]])
+        with self.app.app_context():
+            self.assertEqual(total_before + 2, Question.query.count())
+
+    def test_import_questions_should_reject_null_missing_and_bool_fields(
+        self,
+    ):
+        """Null, missing and boolean fields should be rejected rather than
+        imported as "None" or as category 1."""
+        lines = [
+            '{"question": null, "answer": "A", "category": 1, '
+            '"difficulty": 1}',
+            '{"answer": "A", "category": 1, "difficulty": 1}',
+            '{"question": "Q?", "answer": 42, "category": 1, '
+            '"difficulty": 1}',
+            '{"question": "Q?", "answer": "A", "category": true, '
+            '"difficulty": 1}',
+            '{"question": "Q?", "answer": "A", "category": 1, '
+            '"difficulty": 2.5}',
+        ]
+
+        def delete_imported():
+            with self.app.app_context():
+                for question in Question.query.filter(
+                    Question.question.in_(["None", "Q?"])
+                ):
+                    question.delete()
+
+        ndjson = self.client().post(
+            "/questions/import",
+            data="\n".join(lines),
+            content_type="application/x-ndjson",
+        )
+        self.addCleanup(delete_imported)
+        csv = self.client().post(
+            "/questions/import",
+            data="question,answer,category,difficulty\nQ?,A,1\n",
+            content_type="text/csv",
+        )
+
+        self.assertEqual(0, ndjson.json["imported"])
+        self.assertEqual(
+            [1, 2, 3, 4, 5], [e["line"] for e in ndjson.json["errors"]]
+        )
+        self.assertEqual(0, csv.json["imported"])
+        self.assertEqual(
+            [{"line": 2, "error": "missing 'difficulty'"}],
+            csv.json["errors"],
+        )
+
+    def test_export_questions_should_stream_all_questions_as_csv(self):
+        """The csv export should contain a header and one line per row."""
+        res = self.client().get("/questions/export?format=csv")
+
+        self.assertEqual(200, res.status_code)
+        lines = res.data.decode().splitlines()
+        self.assertEqual("id,question,answer,category,difficulty", lines[0])
+        with self.app.app_context():
+            self.assertEqual(Question.query.count(), len(lines) - 1)
+
+    def test_export_questions_command_should_write_both_formats(self):
+        """flask export-questions should write NDJSON and CSV files."""
+        directory = tempfile.mkdtemp()
+        runner = self.app.test_cli_runner()
+        with self.app.app_context():
+            total = Question.query.count()
+
+        for name in ("questions.ndjson", "questions.csv"):
+            path = os.path.join(directory, name)
+            result = runner.invoke(args=["export-questions", path])
+            self.assertEqual(0, result.exit_code, result.output)
+            with open(path, encoding="utf-8") as exported:
+                lines = exported.read().splitlines()
+            if name.endswith(".csv"):
+                self.assertEqual(
+                    "id,question,answer,category,difficulty", lines.pop(0)
+                )
+            else:
+                self.assertIn("question", json.loads(lines[0]))
+            self.assertEqual(total, len(lines))
+
     def test_search_question_should_return_results(self):
         """Searching a question should return results (assuming at least one match)"""
         res = self.client().post("/questions", json={"searchTerm": "title"})
@@ -156,6 +800,51 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(res.json["total_questions"])
         self.assertTrue(res.json["current_category"])
 
+    def test_search_question_should_rank_whole_word_matches_first(self):
+        """A question containing the search term as a word ranks first."""
+        with self.app.app_context():
+            if self.db.engine.dialect.name != "postgresql":
+                self.skipTest("ranking requires pg_trgm")
+        res = self.client().post("/questions", json={"searchTerm": "title"})
+
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(2, res.json["total_questions"])
+        self.assertIn(" title ", res.json["questions"][0]["question"])
+
+    def test_search_question_should_be_served_from_response_cache(self):
+        """Repeating a search should be answered from the response cache."""
+        cache = self.app.extensions["response_cache"]
+        first = self.client().post("/questions", json={"searchTerm": "title"})
+        hits = cache.stats()["hits"]
+
+        second = self.client().post("/questions", json={"searchTerm": "title"})
+
+        self.assertEqual(hits + 1, cache.stats()["hits"])
+        self.assertEqual(first.json, second.json)
+
+    def test_search_question_cache_should_be_invalidated_by_write(self):
+        """A question added after a search should show up in the results."""
+        search = {"searchTerm": "velociraptor"}
+        res = self.client().post("/questions", json=search)
+        self.assertEqual(0, res.json["total_questions"])
+
+        created = self.client().post(
+            "/questions",
+            json={
+                "question": "What is the fastest velociraptor?",
+                "answer": "Blue",
+                "category": 1,
+                "difficulty": 5,
+            },
+        )
+        self.addCleanup(
+            self.client().delete,
+            "/questions/{}".format(created.json["created"]),
+        )
+        res = self.client().post("/questions", json=search)
+
+        self.assertEqual(1, res.json["total_questions"])
+
     def test_search_question_no_match_should_return_empty_list(self):
         """Empty list should be returned assuming search term with zero matches."""
         res = self.client().post("/questions", json={"searchTerm": "qqqas"})
@@ -170,6 +859,184 @@ class TriviaTestCase(unittest.TestCase):
         self.assertFalse(res.json["questions"])
         self.assertEqual(0, res.json["total_questions"])
 
+    def test_stats_should_count_questions_by_category_and_difficulty(self):
+        """The stats should match counting the questions table."""
+        res = self.client().get("/stats")
+
+        self.assertEqual(200, res.status_code)
+        with self.app.app_context():
+            questions = Question.query.all()
+            self.assertEqual(len(questions), res.json["total_questions"])
+            for category in Category.query.all():
+                stats = res.json["categories"][str(category.id)]
+                self.assertEqual(category.type, stats["type"])
+                self.assertEqual(
+                    sum(1 for q in questions if q.category == category.id),
+                    stats["total_questions"],
+                )
+            for difficulty, count in res.json["difficulties"].items():
+                self.assertEqual(
+                    sum(
+                        1 for q in questions if q.difficulty == int(difficulty)
+                    ),
+                    count,
+                )
+
+    def test_stats_should_follow_question_writes(self):
+        """Inserts, updates and deletes should keep the stats current."""
+
+        def count(category, difficulty):
+            stats = self.client().get("/stats").json
+            return (
+                stats["categories"][str(category)]["difficulties"].get(
+                    str(difficulty), 0
+                ),
+                stats["total_questions"],
+            )
+
+        def write(action, **values):
+            with self.app.app_context():
+                question = Question.query.get(question_id)
+                for name, value in values.items():
+                    setattr(question, name, value)
+                getattr(question, action)()
+
+        before, total = count(2, 5)
+        with self.app.app_context():
+            question = Question("Stats question?", "Yes", 2, 5)
+            question.insert()
+            question_id = question.id
+        inserted = count(2, 5)
+        write("update", difficulty=4)
+        updated = count(2, 5)
+        write("delete")
+        deleted = count(2, 5)
+
+        self.assertEqual((before + 1, total + 1), inserted)
+        self.assertEqual((before, total + 1), updated)
+        self.assertEqual((before, total), deleted)
+
+    def test_suggestions_should_match_word_prefixes(self):
+        """Suggestions should list categories and questions by prefix."""
+        res = self.client().get("/suggestions?q=scien")
+
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(
+            {"type": "category", "id": 1, "text": "Science"},
+            res.json["suggestions"][0],
+        )
+        self.assertTrue(
+            all(
+                "scien" in suggestion["text"].lower()
+                for suggestion in res.json["suggestions"]
+            )
+        )
+
+    def test_suggestions_should_follow_question_writes(self):
+        """New questions should be suggested until they are deleted."""
+        res = self.client().post(
+            "/questions",
+            json={
+                "question": "Which zygomorphic flower is this?",
+                "answer": "Orchid",
+                "category": 1,
+                "difficulty": 2,
+            },
+        )
+        created = res.json["created"]
+
+        found = self.client().get("/suggestions?q=which+zygo")
+        self.client().delete("/questions/{}".format(created))
+        gone = self.client().get("/suggestions?q=zygo")
+
+        self.assertEqual(
+            [created], [s["id"] for s in found.json["suggestions"]]
+        )
+        self.assertEqual([], gone.json["suggestions"])
+
+    def test_suggestions_should_match_rare_required_words(self):
+        """A rare required word should be matched from its own keys rather
+        than scanning every entry with the prefix."""
+        index = PrefixIndex(
+            questions=[(i, "about apples {}".format(i)) for i in range(5000)]
+            + [(5000, "zzzz about apples"), (5001, "zzzz avocado")],
+        )
+
+        matches = index.suggest("zzzz a", 10)
+
+        self.assertEqual([5000, 5001], [match["id"] for match in matches])
+        self.assertEqual(
+            [5000], [match["id"] for match in index.suggest("zzzz ap", 10)]
+        )
+
+    def test_chunked_keys_should_stay_sorted_across_chunks(self):
+        """Inserts and deletes should split and drop chunks while ranges
+        and counts span them."""
+        keys = ChunkedKeys()
+        keys.CHUNK_SIZE = 2
+        words = ["w{:02}".format(i) for i in range(30)]
+        for i, word in enumerate(words):
+            keys.insert((word, 1, i))
+        for i in range(0, 30, 3):
+            keys.remove((words[i], 1, i))
+        keys.remove(("missing", 1, 0))
+
+        expected = [(words[i], 1, i) for i in range(30) if i % 3]
+        self.assertEqual(expected, list(keys.irange("w", "x")))
+        self.assertEqual(
+            [("w10", 1, 10), ("w11", 1, 11)], list(keys.irange("w10", "w12"))
+        )
+        self.assertEqual(20, keys.count("w", "x", 100))
+        self.assertEqual(5, keys.count("w", "x", 5))
+        self.assertGreater(len(keys._chunks), 1)
+
+    def test_expired_suggestions_should_rebuild_in_background(self):
+        """An expired index should keep answering while it is rebuilt."""
+        app = create_app(
+            {
+                "SQLALCHEMY_DATABASE_URI": self.app.config[
+                    "SQLALCHEMY_DATABASE_URI"
+                ],
+                "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+                "SUGGEST_INDEX_TTL": 0,
+                "TESTING": True,
+            }
+        )
+        suggestions = app.extensions["suggestions"]
+        client = app.test_client()
+        with app.app_context():
+            # behind the back of the write listeners, like another process
+            question_id = db.session.execute(
+                "INSERT INTO questions (question, answer, category, "
+                "difficulty) VALUES ('Quixotic?', 'Yes', 1, 1) RETURNING id"
+            ).scalar()
+            db.session.commit()
+
+        def delete():
+            with app.app_context():
+                db.session.execute(
+                    "DELETE FROM questions WHERE id = :id", {"id": question_id}
+                )
+                db.session.commit()
+
+        self.addCleanup(delete)
+
+        stale = client.get("/suggestions?q=quixo")
+        # wait for the rebuild started by the request
+        with suggestions._building:
+            pass
+        fresh = client.get("/suggestions?q=quixo")
+
+        self.assertEqual([], stale.json["suggestions"])
+        self.assertEqual(
+            [question_id], [s["id"] for s in fresh.json["suggestions"]]
+        )
+
+    def test_suggestions_invalid_limit_should_return_422(self):
+        res = self.client().get("/suggestions?q=a&limit=0")
+
+        self.assertEqual(422, res.status_code)
+
     def test_get_questions_of_category_should_return_results(self):
         """Sending GET request to '/categories/<id>/questions' should return results."""
         res = self.client().get("/categories/1/questions")
@@ -213,6 +1080,350 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(res.json["question"])
         self.assertFalse(res.json["question"]["id"] in previous_questions)
 
+    def test_post_quizzes_should_play_every_question_of_category_once(self):
+        """Playing until no question is left should visit the category."""
+        previous_questions = []
+        while True:
+            res = self.client().post(
+                "/quizzes",
+                json={
+                    "previous_questions": previous_questions,
+                    "quiz_category": {"id": 1, "type": "Science"},
+                },
+            )
+            self.assertEqual(200, res.status_code)
+            if "question" not in res.json:
+                break
+            self.assertEqual(1, res.json["question"]["category"])
+            self.assertNotIn(res.json["question"]["id"], previous_questions)
+            previous_questions.append(res.json["question"]["id"])
+
+        with self.app.app_context():
+            category_ids = [
+                q.id for q in Question.query.filter(Question.category == 1)
+            ]
+        self.assertEqual(sorted(category_ids), sorted(previous_questions))
+
+    def test_post_quizzes_with_count_should_return_a_whole_round(self):
+        """A count should return that many distinct unseen questions."""
+        with self.app.app_context():
+            category_ids = [
+                q.id for q in Question.query.filter(Question.category == 1)
+            ]
+        previous_questions = category_ids[:1]
+
+        res = self.client().post(
+            "/quizzes",
+            json={
+                "previous_questions": previous_questions,
+                "quiz_category": {"id": 1, "type": "Science"},
+                "count": len(category_ids),
+            },
+        )
+
+        self.assertEqual(200, res.status_code)
+        self.assertNotIn("question", res.json)
+        played_ids = [question["id"] for question in res.json["questions"]]
+        self.assertEqual(sorted(category_ids[1:]), sorted(played_ids))
+
+    def test_post_quizzes_invalid_count_should_return_422(self):
+        """A count outside of 1 to 100 should be rejected."""
+        for count in (0, 101, "five"):
+            res = self.client().post(
+                "/quizzes", json={"previous_questions": [], "count": count}
+            )
+            self.assertEqual(422, res.status_code)
+
+    def test_post_quizzes_should_handle_long_previous_questions(self):
+        """Excluding all but one question should return the remaining one."""
+        with self.app.app_context():
+            remaining_id = Question.query.order_by(Question.id).first().id
+        previous_questions = [i for i in range(100000) if i != remaining_id]
+        res = self.client().post(
+            "/quizzes",
+            json={"previous_questions": previous_questions},
+        )
+
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(remaining_id, res.json["question"]["id"])
+
+    def test_quiz_session_should_return_distinct_questions(self):
+        """A quiz session should serve its questions once, then stop."""
+        res = self.client().post(
+            "/quizzes/sessions",
+            json={"quiz_category": {"id": 1, "type": "Science"}, "length": 2},
+        )
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(2, res.json["total_questions"])
+        session_id = res.json["session_id"]
+
+        played_ids = []
+        for _ in range(2):
+            res = self.client().post(f"/quizzes/sessions/{session_id}/next")
+            self.assertEqual(200, res.status_code)
+            self.assertEqual(1, res.json["question"]["category"])
+            played_ids.append(res.json["question"]["id"])
+        self.assertEqual(2, len(set(played_ids)))
+
+        res = self.client().post(f"/quizzes/sessions/{session_id}/next")
+        self.assertEqual(200, res.status_code)
+        self.assertTrue(res.json["success"])
+        self.assertNotIn("question", res.json)
+
+    def test_adaptive_session_should_follow_the_players_score(self):
+        """Correct answers should raise the difficulty of the next ones."""
+        res = self.client().post(
+            "/quizzes/sessions",
+            json={"adaptive": True, "quiz_category": {"id": 1}, "length": 3},
+        )
+        session_id = res.json["session_id"]
+        url = "/quizzes/sessions/{}/next".format(session_id)
+
+        played = []
+        targets = []
+        for correct in (None, True, True, True):
+            res = self.client().post(url, json={"correct": correct})
+            self.assertEqual(200, res.status_code)
+            targets.append(res.json["score"]["difficulty"])
+            if "question" in res.json:
+                played.append(res.json["question"])
+
+        self.assertEqual(3, len(played))
+        self.assertEqual(3, len({question["id"] for question in played}))
+        self.assertTrue(all(question["category"] == 1 for question in played))
+        self.assertEqual(3, res.json["score"]["correct"])
+        self.assertEqual(sorted(targets), targets)
+        self.assertGreater(targets[-1], targets[0])
+
+    def test_adaptive_session_non_boolean_answer_should_return_422(self):
+        """Answers such as "no" or 0 should not be scored as correct."""
+        res = self.client().post(
+            "/quizzes/sessions",
+            json={"adaptive": True, "quiz_category": {"id": 1}, "length": 3},
+        )
+        url = "/quizzes/sessions/{}/next".format(res.json["session_id"])
+        self.client().post(url)
+
+        statuses = [
+            self.client().post(url, json={"correct": correct}).status_code
+            for correct in ("no", "false", 0, 1)
+        ]
+        res = self.client().post(url, json={"correct": False})
+
+        self.assertEqual([422] * 4, statuses)
+        self.assertEqual(200, res.status_code)
+        self.assertEqual(
+            {"answered": 1, "correct": 0},
+            {key: res.json["score"][key] for key in ("answered", "correct")},
+        )
+
+    def test_weighted_draws_should_prefer_heavy_difficulties(self):
+        """Draws should come from the weighted difficulties without
+        replacement, and fall back to others once they are played."""
+        index = QuestionIdIndex(
+            (question_id, 1, question_id % 5 + 1)
+            for question_id in range(1, 51)
+        )
+        excluded = set()
+        for _ in range(10):
+            question_id = index.sample_weighted_id({(1, 3): 1.0}, excluded)
+            self.assertEqual(3, question_id % 5 + 1)
+            self.assertNotIn(question_id, excluded)
+            excluded.add(question_id)
+
+        self.assertIsNone(index.sample_weighted_id({(1, 3): 1.0}, excluded))
+        fallback = index.sample_weighted_id(
+            {(1, 3): 1.0, (1, 4): 0.1}, excluded
+        )
+        self.assertEqual(4, fallback % 5 + 1)
+        index.remove(fallback)
+        self.assertEqual(49, index.count(1))
+
+    def test_weighted_draws_should_weight_categories_and_difficulties(self):
+        """Bucket weights should combine category and difficulty weights
+        and only draw from buckets with a weight."""
+        index = QuestionIdIndex(
+            (question_id, question_id % 2 + 1, question_id % 5 + 1)
+            for question_id in range(1, 101)
+        )
+        weights = bucket_weights({1: 1.0, 2: 0.0}, {2: 1.0, 5: 3.0})
+
+        self.assertEqual(3.0, weights[(1, 5)])
+        self.assertEqual(0.0, weights[(2, 2)])
+        excluded = set()
+        for _ in range(20):
+            question_id = index.sample_weighted_id(weights, excluded)
+            self.assertEqual(1, question_id % 2 + 1)
+            self.assertIn(question_id % 5 + 1, (2, 5))
+            excluded.add(question_id)
+        self.assertIsNone(index.sample_weighted_id(weights, excluded))
+
+    def test_quiz_session_unknown_id_should_return_404(self):
+        """Asking for the next question of an unknown session is a 404."""
+        res = self.client().post("/quizzes/sessions/unknown/next")
+
+        self.assertEqual(404, res.status_code)
+        self.assertFalse(res.json["success"])
+
+    def create_limited_app(self, **config):
+        return create_app(
+            {
+                "SQLALCHEMY_DATABASE_URI": self.app.config[
+                    "SQLALCHEMY_DATABASE_URI"
+                ],
+                "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+                "TESTING": True,
+                **config,
+            }
+        )
+
+    def test_rate_limit_should_return_429_once_burst_is_spent(self):
+        """A client over its budget of a route should get a 429."""
+        client = self.create_limited_app(
+            RATE_LIMITS={"POST /quizzes": (0.001, 2)}
+        ).test_client()
+        body = {"previous_questions": []}
+
+        statuses = [
+            client.post("/quizzes", json=body).status_code for _ in range(3)
+        ]
+        res = client.post("/quizzes", json=body)
+        other = client.get("/categories")
+
+        self.assertEqual([200, 200, 429], statuses)
+        self.assertEqual(429, res.status_code)
+        self.assertFalse(res.json["success"])
+        self.assertGreater(int(res.headers["Retry-After"]), 0)
+        self.assertEqual(200, other.status_code)
+
+    def test_rate_limit_store_should_be_shared_between_workers(self):
+        """Apps sharing a RATE_LIMIT_STORE should share the budget."""
+        config = {
+            "RATE_LIMITS": {"GET /categories": (0.001, 1)},
+            "RATE_LIMIT_STORE": os.path.join(tempfile.mkdtemp(), "limits.db"),
+        }
+        first = self.create_limited_app(**config).test_client()
+        second = self.create_limited_app(**config).test_client()
+
+        self.assertEqual(200, first.get("/categories").status_code)
+        self.assertEqual(429, second.get("/categories").status_code)
+
+    def test_rate_limit_should_key_clients_behind_proxy_by_forwarded_for(
+        self,
+    ):
+        """Clients behind a trusted proxy should get their own buckets."""
+        client = self.create_limited_app(
+            RATE_LIMITS={"GET /categories": (0.001, 1)}, PROXY_FIX_X_FOR=1
+        ).test_client()
+
+        def get(address):
+            return client.get(
+                "/categories", headers={"X-Forwarded-For": address}
+            ).status_code
+
+        self.assertEqual(
+            [200, 200, 429],
+            [get("10.0.0.1"), get("10.0.0.2"), get("10.0.0.1")],
+        )
+
+    def test_shed_requests_should_not_spend_rate_limit_tokens(self):
+        """Requests shed with 503 should leave the client's budget alone,
+        and requests limited with 429 should free their concurrency slot."""
+        app = self.create_limited_app(
+            RATE_LIMITS={"GET /categories": (0.001, 1)},
+            CONCURRENCY_LIMITS={"GET /categories": 0},
+        )
+        limiter = app.extensions["rate_limiter"]
+        client = app.test_client()
+
+        shed = [client.get("/categories").status_code for _ in range(3)]
+        limiter.concurrency_limits["GET /categories"] = 1
+        statuses = [client.get("/categories").status_code for _ in range(3)]
+
+        self.assertEqual([503] * 3, shed)
+        self.assertEqual([200, 429, 429], statuses)
+        self.assertEqual(0, limiter.stats()["in_flight"])
+
+    def test_disabled_limits_should_not_be_enforced(self):
+        app = self.create_limited_app(
+            LIMITS_ENABLED=False, CONCURRENCY_LIMITS={"GET /categories": 0}
+        )
+
+        res = app.test_client().get("/categories")
+
+        self.assertEqual(200, res.status_code)
+        self.assertNotIn("rate_limiter", app.extensions)
+
+    def test_concurrency_limit_should_shed_with_503(self):
+        """Requests over a route's concurrency limit should fail fast."""
+        app = self.create_limited_app(
+            CONCURRENCY_LIMITS={"GET /categories": 0}
+        )
+
+        res = app.test_client().get("/categories")
+
+        self.assertEqual(503, res.status_code)
+        self.assertEqual("1", res.headers["Retry-After"])
+        self.assertEqual(1, app.extensions["rate_limiter"].stats()["shed"])
+
+    def serve_asgi(self, requests):
+        """Run the ASGI app through its lifespan and send it `requests`,
+        (method, url) pairs, return the status and json of each response.
+        """
+        app = asgi.create_asgi_app(self.app.config)
+        responses = []
+
+        async def call(scope, messages):
+            sent = []
+
+            async def receive():
+                return messages.pop(0)
+
+            async def send(message):
+                sent.append(message)
+
+            await app(scope, receive, send)
+            return sent
+
+        async def run():
+            await app.startup()
+            try:
+                for method, url in requests:
+                    path, _, query = url.partition("?")
+                    sent = await call(
+                        {
+                            "type": "http",
+                            "method": method,
+                            "path": path,
+                            "query_string": query.encode(),
+                            "headers": [],
+                        },
+                        [{"type": "http.request", "body": b""}],
+                    )
+                    responses.append(
+                        (sent[0]["status"], json.loads(sent[1]["body"]))
+                    )
+            finally:
+                await app.shutdown()
+
+        asyncio.run(run())
+        return responses
+
+    def test_asgi_app_should_serve_same_json_as_wsgi_app(self):
+        """The async entry point should answer like the Flask app."""
+        if asgi.asyncpg is None:
+            self.skipTest("the ASGI app requires asyncpg")
+        with self.app.app_context():
+            if self.db.engine.dialect.name != "postgresql":
+                self.skipTest("the ASGI app requires Postgres")
+        paths = ["/categories", "/questions?page=2", "/categories/1/questions"]
+        responses = self.serve_asgi([("GET", path) for path in paths])
+
+        for path, (status, body) in zip(paths, responses):
+            res = self.client().get(path)
+            self.assertEqual(res.status_code, status)
+            self.assertEqual(res.json, body)
+
     def test_post_quizzes_should_return_422_missing_keys_in_body(self):
         """Sending POST request to '/quizzes' should return a 422 error if required key in body is missing."""
         res = self.client().post(